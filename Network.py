@@ -1,19 +1,20 @@
 import networkx as nx
-import itertools
 import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib as mpl
 import pandas as pd
 from circuit_utils import Circuit
+from topology_utils import RKMTopology
 
 
 class RKMNetwork:
+    # ohms, full-scale resistance of the ideal digipots of the legs
+    FULL_SCALE = 1e5
+
     def __init__(self, numV = 2, numH = 1):
         self._NV = numV
         self._NH = numH
-        self.generate(self._NV, self._NH)
-        self.generate_full(self._NV, self._NH)
-        self.set_keys()
+        self._set_topology(RKMTopology(self._NV, self._NH))
 
         
 #         self._NE = len(self._graph.edges())
@@ -26,9 +27,7 @@ class RKMNetwork:
     @NV.setter
     def NV(self, value):
         self._NV = value
-        self.generate(self._NV, self._NH, doset=True)
-        self.generate_full(self._NV, self._NH, doset=True)
-        self.set_keys()
+        self._set_topology(RKMTopology(self._NV, self._NH))
     
     @property
     def NH(self):
@@ -37,9 +36,7 @@ class RKMNetwork:
     @NH.setter
     def NH(self, value):
         self._NH = value
-        self.generate(self._NV, self._NH, doset=True)
-        self.generate_full(self._NV, self._NH, doset=True)
-        self.set_keys()
+        self._set_topology(RKMTopology(self._NV, self._NH))
         
     @property
     def edge(self):
@@ -57,8 +54,17 @@ class RKMNetwork:
 #     def node(self, value):
 #         self._node = value
         
+    @property
+    def topology(self):
+        return self._topology
+
     @property
     def graph(self):
+        # networkx graphs are only built when asked for
+        if self._graph is None:
+            self._graph = self._topology.graph(self._k)
+            self._ksynced = True
+        self._sync_graph()
         return self._graph
         
 #     @graph.setter
@@ -67,6 +73,8 @@ class RKMNetwork:
         
     @property
     def pos(self):
+        if self._pos is None:
+            self._pos = dict(zip(self._topology.node_names, self._topology.positions().tolist()))
         return self._pos
         
 #     @pos.setter
@@ -75,6 +83,8 @@ class RKMNetwork:
         
     @property
     def fullgraph(self):
+        if self._fullgraph is None:
+            self._fullgraph = self._topology.fullgraph()
         return self._fullgraph
         
 #     @graph.setter
@@ -85,7 +95,19 @@ class RKMNetwork:
         
     @property
     def fullpos(self):
+        if self._fullpos is None:
+            self._fullpos = dict(zip(self._topology.full_node_names,
+                                     self._topology.full_positions().tolist()))
         return self._fullpos
+
+    @property
+    def circuit(self):
+        # built once per topology; only conductances and clamps change between solves
+        if self._circuit is None:
+            t = self._topology
+            self._circuit = Circuit.from_edges(np.stack([t.full_a, t.full_b], axis=1),
+                                               t.full_positions())
+        return self._circuit
         
 #     @pos.setter
 #     def fullpos(self, value):
@@ -101,11 +123,11 @@ class RKMNetwork:
 
     def draw_network(self, full=False, **kwargs):
         if full:
-            G = self._fullgraph
-            pos = self._fullpos
+            G = self.fullgraph
+            pos = self.fullpos
         else:
-            G = self._graph
-            pos = self._pos
+            G = self.graph
+            pos = self.pos
         print(G)
         fig, ax = plt.subplots()
         nx.draw_networkx(G, pos=pos, node_size=800, ax=ax, **kwargs)
@@ -129,7 +151,7 @@ class RKMNetwork:
             nrange = [np.min(nodeweights), np.max(nodeweights)]
 
         fig, ax = plt.subplots()
-        nx.draw_networkx(self._graph, pos=self._pos, node_size=800, ax=ax,
+        nx.draw_networkx(self.graph, pos=self.pos, node_size=800, ax=ax,
                                    width= np.abs(edgeweights)/128*60, edge_cmap = ecm, edge_color = edgeweights, 
                                     node_color = nodeweights, cmap = ncm)
         
@@ -167,7 +189,7 @@ class RKMNetwork:
             nrange = [np.min(nodeweights), np.max(nodeweights)]
 
         fig, ax = plt.subplots()
-        nx.draw_networkx(self._fullgraph, pos=self._fullpos, node_size=800, ax=ax,
+        nx.draw_networkx(self.fullgraph, pos=self.fullpos, node_size=800, ax=ax,
                                    #width= edgeweights/np.max(edgeweights)*10, 
                                  width=2.,
                                  edge_cmap = ecm, edge_color = edgeweights, 
@@ -190,291 +212,150 @@ class RKMNetwork:
         
         return fig, ax
     
-    def generate_full(self, lenV=2, lenH=1, ysep = 2., lrxsep = 2., midxsep = 4., pmsep = 0.4, doset=True):
-        
-        G = nx.Graph()
-        
-        nodes = ['L+', 'L-', 'R+', 'R-']
-
-        edges = []
-        for vi in range(lenV):
-            nodes.append('V{}+'.format(vi))
-            nodes.append('V{}-'.format(vi))
-
-            edges.append(('L+', 'V{}+'.format(vi)))
-            edges.append(('L-', 'V{}+'.format(vi)))
-
-        for hi in range(lenH):
-            nodes.append('H{}+'.format(hi))
-            nodes.append('H{}-'.format(hi))
-
-            edges.append(('R+', 'H{}+'.format(hi)))
-            edges.append(('R-', 'H{}+'.format(hi)))
-
-        for n in nodes:
-            G.add_node(n)
-
-        for vi, hi in itertools.product(np.arange(lenV), np.arange(lenH)):
-#             print(vi, hi)
-            edges.append(('V{}+'.format(vi), 'H{}+'.format(hi)))
-            edges.append(('V{}+'.format(vi), 'H{}-'.format(hi)))
-            edges.append(('V{}-'.format(vi), 'H{}+'.format(hi)))
-
-        G.add_edges_from(edges)
-
-
-        pos = {'L-': [0, -pmsep*2], 'L+': [0,pmsep*2], 
-               'R-': [lrxsep*2 + midxsep, -pmsep*2], 'R+':[lrxsep*2+midxsep, pmsep*2]}
-             
-        midV = lenV/2.
-        midH = lenH/2.
-
-        if lenV%2==0:
-            Vystart = .5 - midV
-        else:
-            Vystart = -midV+0.5
+    def _set_topology(self, topology, k=None):
+        self._topology = topology
+        self._NV = topology.NV
+        self._NH = topology.NH
+        # networkx graphs and layouts are built lazily from the index arrays
+        self._graph = None
+        self._pos = None
+        self._fullgraph = None
+        self._fullpos = None
+        # k values live in an array in edge order; the graph attributes are synced lazily
+        self._kindex = {name: i for i, name in enumerate(topology.edge_names)}
+        if k is None:
+            k = np.random.randint(-128, 128, size=topology.n_edges)
+        self._k = np.array(k, dtype=int)
+        self._ksynced = True
+        # every full-graph edge is one leg of a logical edge
+        self._fulledge_index = topology.full_edge
+        self._fulledge_pm = topology.full_pm
+        self._circuit = None
+        self._clampnodes = {}
+        # calibrated resistances of the legs (calibration_utils.WiperCalibration); None is the ideal digipot
+        self.resistance_model = None
+        self.set_keys()
 
-        if lenH%2==0:
-            Hystart = .5 - midH
-        else:
-            Hystart = -midH+0.5
-
-        for vi in range(lenV):
-            pos['V{}+'.format(vi)] = [lrxsep, -(vi+Vystart)*ysep+pmsep]
-            pos['V{}-'.format(vi)] = [lrxsep, -(vi+Vystart)*ysep-pmsep]
-
-        for hi in range(lenH):
-            pos['H{}+'.format(hi)] = [lrxsep + midxsep, -(hi+Hystart)*ysep+pmsep]
-            pos['H{}-'.format(hi)] = [lrxsep+ midxsep, -(hi+Hystart)*ysep-pmsep]
-
-        attrs = {}
-        for key, val in pos.items():
-            name = key[:-1]
-            if key[-1] == '+':
-                pm = 1
-            else:
-                pm = 0
-            attrs[key] = {'pos': val, 'name': name, 'pm': pm}
-
-        nx.set_node_attributes(G, attrs)
-
-        attrs = {}
-
-        for edge in G.edges:
-            a,b = edge
-            if 'L' in a or 'R' in a:
-                if a[1] == '+':
-                    pm = 1
-                else:
-                    pm = 0
-                name = 'B' + b[:2]
-            else:
-                if '-' in a or '-' in b:
-                    pm = 0
-                else:
-                    pm = 1
-                name = 'W' + a[1] + b[1]
-
-        #     print(a,b)
-        #     print(name)
-
-            attrs[edge] = {'name': name, 'pm': pm}
-
-        nx.set_edge_attributes(G, attrs)
-            
+    def generate_full(self, lenV=2, lenH=1, ysep = 2., lrxsep = 2., midxsep = 4., pmsep = 0.4, doset=True):
+        topology = RKMTopology(lenV, lenH, ysep=ysep, lrxsep=lrxsep, midxsep=midxsep, pmsep=pmsep)
         if doset:
-            self._fullgraph = G
-            self._fullpos = pos
-            
-        return G, pos
-    
-    def generate(self, lenV=2, lenH=1, ysep = 2., lrxsep = 2., midxsep = 4., pmsep = 0.4, doset=True):
-        
-        G = nx.Graph()
-        
-        nodes = ['L', 'R']
-
-        edges = []
-        for vi in range(lenV):
-            nodes.append('V{}'.format(vi))
-
-            edges.append(('L', 'V{}'.format(vi)))
-
-        for hi in range(lenH):
-            nodes.append('H{}'.format(hi))
-
-            edges.append(('R', 'H{}'.format(hi)))
-
-        for n in nodes:
-            G.add_node(n)
-
-        for vi, hi in itertools.product(np.arange(lenV), np.arange(lenH)):
-#             print(vi, hi)
-            edges.append(('V{}'.format(vi), 'H{}'.format(hi)))
-
-        G.add_edges_from(edges)
-
+            same = (lenV, lenH) == (self._NV, self._NH)
+            self._set_topology(topology, k=self._k if same else None)
+            return self.fullgraph, self.fullpos
+        return topology.fullgraph(), dict(zip(topology.full_node_names, topology.full_positions().tolist()))
 
-        pos = {'L': [0, 0],  'R': [lrxsep*2 + midxsep, 0]}
-             
-        midV = lenV/2.
-        midH = lenH/2.
-
-        if lenV%2==0:
-            Vystart = .5 - midV
-        else:
-            Vystart = -midV+0.5
-
-        if lenH%2==0:
-            Hystart = .5 - midH
-        else:
-            Hystart = -midH+0.5
-
-        for vi in range(lenV):
-            pos['V{}'.format(vi)] = [lrxsep, -(vi+Vystart)*ysep]
-
-        for hi in range(lenH):
-            pos['H{}'.format(hi)] = [lrxsep + midxsep, -(hi+Hystart)*ysep]
-            
-        attrs = {}
-
-        for edge in G.edges:
-            a,b = edge
-            if 'L' in a or 'R' in a:
-                name = 'B' + b[:2]
-            else:
-                name = 'W' + a[1] + b[1]
-
-#             print(a,b)
-#             print(name)
-
-        #     k = np.sign(np.random.uniform(-1., 1.))
-            k = np.random.randint(-128, 128)
-#             print(k)
-
-            attrs[edge] = {'name': name, 'k': k}
-
-        nx.set_edge_attributes(G, attrs)
-
-            
+    def generate(self, lenV=2, lenH=1, ysep = 2., lrxsep = 2., midxsep = 4., pmsep = 0.4, doset=True):
+        topology = RKMTopology(lenV, lenH, ysep=ysep, lrxsep=lrxsep, midxsep=midxsep, pmsep=pmsep)
         if doset:
-            self._graph = G
-            self._pos = pos
-            
-        return G, pos
+            self._set_topology(topology)
+            return self.graph, self.pos
+        k = np.random.randint(-128, 128, size=topology.n_edges)
+        return topology.graph(k), dict(zip(topology.node_names, topology.positions().tolist()))
+
+    def _sync_graph(self):
+        if self._graph is not None and not self._ksynced:
+            ks = dict(zip(self._graph.edges, self._k.tolist()))
+            nx.set_edge_attributes(self._graph, ks, 'k')
+            self._ksynced = True
     
     def set_k(self, edgename, val):
-        edge = [(u,v) for u,v,e in self._graph.edges(data=True) if e['name'] == edgename][0]
-        
-        nx.set_edge_attributes(self._graph, {edge: {"k": val}})
-#         print(self._graph.edges[edge])
+        self._k[self._kindex[edgename]] = val
+        self._ksynced = False
 
     def load_state(self, row):
-        for key in row.keys():
-            if key[0] == 'B' or key[0] == 'W':
-#                 print(key)
-                val = row[key]
-#                 print(val)
-                self.set_k(key, val)
-
-    def get_ks(self):
-        ks = []
-        for u,v,e in self._graph.edges(data=True):
-            k = e['k']
-            ks.append(k)
-        return ks
-        
-    def get_conductances(self):
-        conductances = []
-        for e in self._fullgraph.edges:
-            name = self._fullgraph.edges[e]['name']
-            pm = self._fullgraph.edges[e]['pm']
-
-
-            k = [e['k'] for u,v,e in self._graph.edges(data=True) if e['name'] == name][0]
+        keys = [key for key in row.keys() if key[0] == 'B' or key[0] == 'W']
+        self._k[[self._kindex[key] for key in keys]] = [row[key] for key in keys]
+        self._ksynced = False
 
-            if pm != int(k>0):
-                realres = 1e5 #ohms
-            else:
-                realval = np.abs(k)
-                realres = 1e5*(1-realval/128.)
+    def load_states(self, df):
+        ''' k values of every row of a training trajectory, as an (n_rows, n_edges) array in edge order. '''
+        return df[list(self._kindex)].to_numpy()
 
-            realk = 1./realres
-
-            conductances.append(realk)
-        return conductances
+    def get_ks(self):
+        return self._k.copy()
+        
+    def get_conductances(self, k=None):
+        ''' Conductances of the full-graph edges for the logical edge values k.
+
+        k defaults to the current state. A 2D k (e.g. epochs x edges) returns
+        one row of conductances per row of k.
+        '''
+        realres = self.ideal_resistances(k)
+        if self.resistance_model is not None:
+            realres = self.resistance_model.resistances(realres)
+
+        return 1./realres
+
+    def ideal_resistances(self, k=None):
+        ''' Resistances (ohms) of the full-graph edges for the logical edge values k, with ideal digipots.
+
+        k defaults to the current state; a 2D k returns one row per row of k.
+        '''
+        if k is None:
+            k = self.get_ks()
+        k = np.asarray(k)[..., self._fulledge_index]
+        # a leg whose polarity does not match the sign of k is left open at FULL_SCALE
+        return np.where(self._fulledge_pm == (k > 0), self.FULL_SCALE*(1-np.abs(k)/128.), self.FULL_SCALE)
+
+    def get_conductance_derivatives(self, k=None, side=1):
+        ''' Derivatives dg/dk of the full-graph edge conductances with respect to their logical edge values k.
+
+        g = 1/(FULL_SCALE*(1-|k|/128)) on the leg matching the sign of k, so
+        dg/dk = +-g**2*FULL_SCALE/128 there (times the scale of a resistance_model)
+        and 0 on the open leg. At k = 0 the
+        conducting leg depends on the direction: side=1 gives the derivative
+        for increasing k (the + leg), side=-1 for decreasing k (the - leg).
+        '''
+        if k is None:
+            k = self.get_ks()
+        k = np.asarray(k)[..., self._fulledge_index]
+        sign = np.where(k == 0, side, np.sign(k))
+        realres = self.FULL_SCALE*(1-np.abs(k)/128.)
+        slope = sign*self.FULL_SCALE/128.
+        if self.resistance_model is not None:
+            realres = self.resistance_model.resistances(realres)
+            slope = slope*self.resistance_model.scale
+        return np.where(self._fulledge_pm == (sign > 0), slope/realres**2, 0.)
     
     def set_keys(self):
-        edgekeys = []
-        isweight = []
-        Anodekeys = []
-        Bnodekeys = []
-
-        for edge in self.graph.edges:
-            a, b = edge
-            if (a=='L') or (a=='R'):
-                edgekeys.append('B'+b)
-                isweight.append(0)
-                Anodekeys.append('A0')
-                Bnodekeys.append(b)
-            else:
-                vi = a.split('V')[1]
-                hi = b.split('H')[1]
-                edgekeys.append('W'+vi+hi)
-                isweight.append(1)
-                Anodekeys.append(a)
-                Bnodekeys.append(b)
-
-        nodekeys = np.unique([Anodekeys, Bnodekeys])
-
-#         print(edgekeys)
-#         print(isweight)
-#         print(Anodekeys)
-#         print(Bnodekeys)
-#         print(nodekeys)
-        
-        ekeydf = pd.DataFrame({'name': edgekeys, 'isWeight': isweight, 'Anode': Anodekeys, 'Bnode': Bnodekeys})
-        nkeydf = pd.DataFrame({'name':nodekeys})
-#                  , 'node':nodekeys}
-#         print(keydf)
-        
-        self._edge = ekeydf
-        self._node = nkeydf
-
-    def clamp(self, FB=0, vals = [1,1], analogRails = [1.0, 3.0]):
+        self._edge = self._topology.edge_frame()
+        self._node = self._topology.node_frame()
+
+    def _clamp_nodes(self, FB):
+        # full-graph indices, unit index (-1 for the L/R boundary nodes) and polarity
+        # of the nodes clamped in direction FB, computed once per topology
+        if FB not in self._clampnodes:
+            t = self._topology
+            fullnodes = np.arange(2 * t.n_nodes)
+            logical = fullnodes // 2
+            unit = logical - 2 - (t.NV if FB == 1 else 0)
+            count = {0: t.NV, 1: t.NH}.get(FB, 0)
+            boundary = logical < 2
+            indices = np.flatnonzero(boundary | ((unit >= 0) & (unit < count)))
+            units = np.where(boundary, -1, unit)[indices]
+            self._clampnodes[FB] = (indices, units, fullnodes[indices] % 2 == 0)
+        return self._clampnodes[FB]
+
+    def clamp_patterns(self, FB=0, patterns = [[1,1]], analogRails = [1.0, 3.0]):
+        ''' Clamped node indices and an (n_patterns, n_clamped) array of clamp values for a batch of binary patterns. '''
         aZero = np.mean(analogRails)
         aPlus = analogRails[1]
         aMinus = analogRails[0]
-        
-        # boundary nodes
-#         indices = np.where(['L' in x or 'R' in x for x in rkm.fullgraph.nodes])[0]
-        indices = [0,1,2,3]
-        clampvals = [aPlus, aMinus, aPlus, aMinus]
-#         print(indices, clampvals)
-        
-        for nodename in self._node.name:
-            if ('V' in nodename and FB==0) or ('H' in nodename and FB==1):
-                idx = int(nodename[1:])
-                val = vals[idx]
-                fullnodes = [u for u,n in self._fullgraph.nodes(data=True) if n['name'] == nodename]
-                for fn in fullnodes:
-                    nodeidx = [i for i, x in enumerate(self._fullgraph.nodes) if x==fn][0]
-#                     print(fn, nodeidx)
-                    pm = self._fullgraph.nodes[fn]['pm']
-#                     print(pm)
-                    indices.append(nodeidx)
-                    if val == 0:
-                        cval = aZero
-                    else:
-                        if pm:
-                            cval = aPlus
-                        else:
-                            cval = aMinus
-                    clampvals.append(cval)
-        return np.array(indices), np.array(clampvals)
+
+        indices, units, pm = self._clamp_nodes(FB)
+        patterns = np.atleast_2d(patterns)
+
+        # boundary nodes are always driven to the rails
+        vals = np.where(units >= 0, patterns[:, units], 1)
+        clampvals = np.where(vals == 0, aZero, np.where(pm, aPlus, aMinus))
+        return indices, clampvals
+
+    def clamp(self, FB=0, vals = [1,1], analogRails = [1.0, 3.0]):
+        indices, clampvals = self.clamp_patterns(FB=FB, patterns=[vals], analogRails=analogRails)
+        return indices, clampvals[0]
     
     def clamp_solve(self, FB=0, vals = [1,1], analogRails = [1.0, 3.0], plot=True):
-        c = Circuit(self._fullgraph)
+        c = self.circuit
 
         conductances = self.get_conductances()
 
@@ -486,8 +367,104 @@ class RKMNetwork:
         
         if plot:
             self.draw_fullnetwork_state(conductances, nodeweights=-1*V)
-        return dict(zip(self._fullgraph.nodes, V))
+        return dict(zip(self._topology.full_node_names, V))
+
+    def clamp_solve_many(self, FB=0, patterns = [[1,1]], analogRails = [1.0, 3.0]):
+        ''' Node voltages (n_patterns, n_nodes) for a batch of clamp patterns, from one factorization. '''
+        c = self.circuit
+        c.setConductances(self.get_conductances())
+
+        indices_nodes, F = self.clamp_patterns(FB=FB, patterns = patterns, analogRails = analogRails)
+        Q = c.constraint_matrix(indices_nodes)
+        return c.solve_many(Q, F)
     
+    def clamp_solve_states(self, k, FB=0, patterns = [[1,1]], analogRails = [1.0, 3.0]):
+        ''' Node voltages (n_states, n_patterns, n_nodes) for a batch of k states (e.g. every epoch of a trajectory). '''
+        c = self.circuit
+        indices_nodes, F = self.clamp_patterns(FB=FB, patterns = patterns, analogRails = analogRails)
+        T = c.transfer_batch(c.constraint_matrix(indices_nodes), self.get_conductances(np.atleast_2d(k)))
+        return np.einsum('snc,pc->spn', T, F)
+
+    def clamp_sensitivity(self, FB=0, vals = [1,1], weights=None, analogRails = [1.0, 3.0], side=1):
+        ''' Derivatives of the clamped node voltages with respect to the k values, by adjoint solves.
+
+        weights (n_nodes, or m x n_nodes) selects weighted sums of the node
+        voltages, e.g. the gradient of a loss dL/dV, whose derivatives need a
+        single adjoint solve. side picks the one-sided derivative at k = 0
+        (see get_conductance_derivatives).
+
+        Returns an (n_nodes, n_edges) Jacobian, or (n_edges,) / (m, n_edges)
+        gradients, in full_node_names and edge order.
+        '''
+        c = self.circuit
+        c.setConductances(self.get_conductances())
+
+        indices_nodes, f = self.clamp(FB=FB, vals = vals, analogRails = analogRails)
+        dVdg = c.sensitivity(c.constraint_matrix(indices_nodes), f, weights=weights)
+        # every leg contributes to the derivative of its logical edge
+        dVdg = dVdg * self.get_conductance_derivatives(side=side)
+        dVdk = np.zeros(dVdg.shape[:-1] + (len(self._k),))
+        np.add.at(dVdk.T, self._fulledge_index, dVdg.T)
+        return dVdk
+
+    def replay(self, df, analogRails = [1.0, 3.0]):
+        ''' Circuit-model predictions of the node measurements logged in a training trajectory.
+
+        Every row is solved with its own k values (get_conductances), all rows
+        in one batched pass, for the three clamped configurations of the last
+        training step of the epoch:
+
+        - D phase: V clamped to DV, predicts the hidden states DH.
+        - R phase, backward: H clamped to DH predicts the visible voltages aV.
+          The hidden state of the first forward pass is not logged; DH (same
+          clamp, same comparators) stands in for it. The visible states RV
+          digitize these voltages near the threshold and do not follow from DH
+          (their residuals are no better than chance), so RV is not predicted.
+        - R phase, forward: V clamped to the logged RV, predicts the hidden
+          voltages aH and states RH.
+
+        States are the + node voltages thresholded at mean(analogRails). df may
+        hold several trials (e.g. concatenated trainXX.csv files). Rows without
+        measurements (the initial row) or with a wiper at |k| = 128 (a shorted
+        leg in the model) give NaN.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Columns DH*, aV*, aH*, RH*, aligned with df, so that
+            df[pred.columns] - pred are the residuals.
+        '''
+        aZero = np.mean(analogRails)
+        Vnames = ['V{}'.format(i) for i in range(self._NV)]
+        Hnames = ['H{}'.format(j) for j in range(self._NH)]
+        measured = df[['D' + n for n in Vnames + Hnames] + ['R' + n for n in Vnames]].to_numpy(dtype=float)
+        ks = self.load_states(df)
+        valid = np.all(np.isfinite(measured), axis=1) & np.all(np.abs(ks) < 128, axis=1)
+
+        c = self.circuit
+        G = self.get_conductances(ks[valid])
+        DV, DH, RV = np.split(measured[valid].astype(int), [self._NV, self._NV + self._NH], axis=1)
+        Vplus = self._topology.plus_nodes('V')
+        Hplus = self._topology.plus_nodes('H')
+
+        transfer = {}
+        def solve(FB, patterns, plus):
+            indices_nodes, F = self.clamp_patterns(FB=FB, patterns=patterns, analogRails=analogRails)
+            if FB not in transfer:
+                transfer[FB] = c.transfer_batch(c.constraint_matrix(indices_nodes), G)[:, plus]
+            return np.einsum('rnc,rc->rn', transfer[FB], F)
+
+        aD = solve(0, DV, Hplus)
+        aV = solve(1, DH, Vplus)
+        aH = solve(0, RV, Hplus)
+        predicted = np.concatenate([aD > aZero, aV, aH, aH > aZero], axis=1)
+        columns = (['D' + n for n in Hnames] + ['a' + n for n in Vnames]
+                   + ['a' + n for n in Hnames] + ['R' + n for n in Hnames])
+        out = np.full((len(df), len(columns)), np.nan)
+        out[valid] = predicted
+        pred = pd.DataFrame(out, index=df.index, columns=columns)
+        return pred
+
     def run_nodechecks(self, nA, nB):
         check = True
         nA = np.array(nA)
@@ -1,14 +1,54 @@
 from func_timeout import func_timeout, FunctionTimedOut
 import time
-import ast
+import queue
+import threading
+from collections import namedtuple
 import numpy as np
 
+from serial_utils import (FRAME_HEADER, FRAME_INT16, FRAME_MAX_COUNT, FRAME_NAMES, FRAME_START,
+                          decode_frame, frame_size)
+from storage_utils import EpochLog
+
+LineError = namedtuple('LineError', ['line', 'reason'])
+_FRAME_BYTE = bytes([FRAME_START])
+
+
+def _msgvar_value(val):
+    # sendMessageWithVarToPython sends ints; records hold them as ints, as simulate_training does
+    try:
+        return int(val)
+    except ValueError:
+        return val
+
+
+def _parse_int_array(payload):
+    # '[1, -2, 3]' (or a shape like '(2, 3)') straight into an integer array
+    fields = payload.strip().strip('[]()').split(',')
+    if fields[-1].strip() == '':
+        fields = fields[:-1]
+    return np.array(fields, dtype=np.int64)
+
+
 class ReadWrite:
     
-    def __init__(self, ser=None, divider=':', NMS = 1):
+    def __init__(self, ser=None, divider=':', NMS = 1, reader='thread', poll_interval=0.02,
+                 frame_stall=1., max_frame_count=FRAME_MAX_COUNT):
         self.ser = ser or None
         self._divider = divider
         
+        # 'thread': every readline runs under func_timeout (one thread per line)
+        # 'buffered': pyserial timeout/in_waiting reads into a persistent receive buffer
+        if reader not in ('thread', 'buffered'):
+            raise ValueError("reader must be 'thread' or 'buffered', not {!r}".format(reader))
+        self.reader = reader
+        self.poll_interval = poll_interval
+        self._rxbuf = bytearray()
+        # a binary frame longer than max_frame_count values, or incomplete with no
+        # byte received for frame_stall seconds, is dropped as corrupt
+        self.frame_stall = frame_stall
+        self.max_frame_count = max_frame_count
+        self._rxtime = time.monotonic()
+        
         self._conversions = {'readConvert': (3.3)/(4095.), #convert int read value into volts
                             'writeConvert': (255.0)/ (0.445), #convert volt write value into ints
                             'nodeGain': 6.0, #op amp gain for node readings
@@ -34,6 +74,8 @@ class ReadWrite:
   
 
     def read_safe(self, timeoutval = 0.1):
+        if self.reader == 'buffered':
+            return self.read_buffered(timeoutval)
         try:
             line = func_timeout(timeoutval, self.ser.readline)
             # print(line)
@@ -42,6 +84,61 @@ class ReadWrite:
             # print("Exception: No line to read")
             return(None)
         
+    def read_buffered(self, timeoutval = 0.1):
+        ''' Next line (or binary frame) from the receive buffer, reading the port without helper threads. None on timeout. '''
+        if self.ser.timeout != self.poll_interval:
+            # set once: changing the timeout reconfigures a real port
+            self.ser.timeout = self.poll_interval
+        deadline = time.monotonic() + timeoutval
+        while True:
+            if self._rxbuf[:1] == _FRAME_BYTE:
+                # binary frame: length from the header, its payload may contain newlines
+                end = self._frame_end()
+                if end < 0 or (end == 0 and time.monotonic() - self._rxtime >= self.frame_stall):
+                    # a corrupt header, a bad checksum or a frame that stopped arriving;
+                    # a frame still arriving stays in the buffer for the next call
+                    return self._resync()
+            else:
+                end = self._rxbuf.find(b'\n') + 1
+            if end > 0:
+                line = bytes(self._rxbuf[:end])
+                del self._rxbuf[:end]
+                return line
+            if time.monotonic() >= deadline:
+                return None
+            # returns at once with whatever is waiting, or after poll_interval with at most one byte
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            if chunk:
+                self._rxbuf += chunk
+                self._rxtime = time.monotonic()
+
+    def _frame_end(self):
+        # length of the complete frame at the start of the receive buffer, 0 if
+        # it is not complete yet, -1 if it cannot be a valid frame
+        buf = self._rxbuf
+        if len(buf) > 1 and buf[1] != FRAME_INT16 or len(buf) > 2 and buf[2] >= len(FRAME_NAMES):
+            return -1
+        if len(buf) < FRAME_HEADER:
+            return 0
+        if (buf[3] | buf[4] << 8) > self.max_frame_count:
+            return -1
+        end = frame_size(buf)
+        if end > len(buf):
+            return 0
+        with memoryview(buf) as view:
+            checksum = sum(view[1:end - 1]) & 0xFF
+        return end if checksum == buf[end - 1] else -1
+
+    def _resync(self):
+        # drop the start byte and return everything up to the next start byte or
+        # line end, which the parser reports as a LineError
+        nextframe = self._rxbuf.find(_FRAME_BYTE, 1)
+        end = self._rxbuf.find(b'\n', 1) + 1
+        if end <= 0 or 0 < nextframe < end:
+            end = nextframe if nextframe > 0 else len(self._rxbuf)
+        line = bytes(self._rxbuf[:end])
+        del self._rxbuf[:end]
+        return line
         
     def clear_output(self):
         data = 1
@@ -49,49 +146,120 @@ class ReadWrite:
             data = self.read_safe()
             
             
-    def send_message(self, message):
+    def send_message(self, message, settle = 0.2):
         self.ser.write((message + "\n").encode())
-        time.sleep(0.2)
+        time.sleep(settle)
 
             
-    def interpret(self, byteval, suppress = False):
-        if byteval is None:
-            return
-        strval = byteval.decode("utf-8")
+    def _parse(self, byteval):
+        # buffer:type:name:payload:buffer framing of the firmware send* functions
+        if byteval[:1] == _FRAME_BYTE:
+            try:
+                varname, array = decode_frame(byteval)
+            except ValueError as err:
+                return None, None, LineError(byteval, str(err))
+            return '1Darr', varname, array
+        try:
+            strval = byteval.decode("utf-8")
+        except UnicodeDecodeError:
+            return None, None, LineError(byteval, 'not utf-8')
         messages = strval.split("\r")[0].split(self._divider)
+        if len(messages) < 4:
+            return None, None, LineError(byteval, 'missing fields')
+        msgtype = messages[1]
+        if msgtype == 'msg':
+            return msgtype, messages[2], None
+        if msgtype not in ('msgvar', '1Darr', 'arr'):
+            return None, None, LineError(byteval, 'unknown message type {!r}'.format(msgtype))
+        if len(messages) < (6 if msgtype == 'arr' else 5):
+            return None, None, LineError(byteval, 'missing fields')
+        varname = messages[2]
+        if msgtype == 'msgvar':
+            return msgtype, varname, messages[3]
         try:
-            msgtype = messages[1]
+            array = _parse_int_array(messages[3])
+            if msgtype == 'arr':
+                array = array.reshape(_parse_int_array(messages[4]))
+        except ValueError:
+            return None, None, LineError(byteval, 'bad {} payload for {!r}'.format(msgtype, varname))
+        return msgtype, varname, array
+
+    def parse_line(self, byteval):
+        ''' Parse one line sent by the supervisor.
+
+        Returns (varname, val): val is None for a plain message, a str for a
+        msgvar, and an integer numpy array for 1Darr/arr payloads (for a binary
+        frame a view of the frame bytes, not a copy). A malformed line gives
+        (None, LineError(line, reason)). interpret, and so the records of
+        train_measure, convert 1Darr payloads to lists.
+        '''
+        msgtype, varname, val = self._parse(byteval)
+        return varname, val
+
+    def interpret(self, byteval, suppress = False, asarray = False):
+        if byteval is None:
+            return
+        msgtype, varname, val = self._parse(byteval)
+        if msgtype is None:
+            if not suppress:
+                print("exception: {}".format(val.reason))
+                print(val.line)
+            return varname, val
+        if msgtype == '1Darr' and not asarray:
+            # records keep plain lists so they round-trip through CSV files
+            val = val.tolist()
+        if not suppress:
             if msgtype == 'msg':
-                msg = messages[2]
-                if not suppress:
-                    print(msg)
-                return msg, None
-            elif msgtype == 'msgvar':
-                varname = messages[2]
-                val = messages[3]
-                if not suppress:
-                    print("{}, {}".format(varname,val))
-                return varname, val
-            elif msgtype == '1Darr':
-                varname = messages[2]
-                array = ast.literal_eval(messages[3])
-                if not suppress:
-                    print("{}, {}".format(varname,array))
-                return varname, array
-            elif msgtype == 'arr':
-                varname = messages[2]
-                arrshape = ast.literal_eval(messages[4])
-                array = ast.literal_eval(messages[3])
-                array = np.array(array)
-                array = array.reshape(arrshape)
-                return varname, array
-        except: 
-            print("exception:")
-            print(messages)
+                print(varname)
+            elif msgtype != 'arr':
+                print("{}, {}".format(varname,val))
+        return varname, val
             
-    def send_recieve(self, message, timeoutval=1000., suppress = False):
+    def set_binary(self, on=True, timeoutval=10.):
+        ''' Switch the supervisor between binary frames and ASCII lines for array messages. '''
+        if on and self.reader != 'buffered':
+            # readline would split frames at payload bytes that happen to be newlines
+            raise ValueError("binary frames need reader='buffered'")
+        self.send_recieve("binmode;{};".format(int(on)), timeoutval=timeoutval, suppress=True)
+
+    def command(self, message, timeoutval=10., suppress = True):
+        ''' Send one command and wait for its acknowledgement; returns the values it reported. '''
+        return self.commands([message], timeoutval=timeoutval, suppress=suppress)[0]
+
+    def commands(self, messages, window=4, timeoutval=10., suppress = True):
+        ''' Send commands back-to-back, waiting on acknowledgements instead of fixed sleeps.
+
+        At most window commands are unacknowledged at any time (the supervisor
+        reads them from its serial receive buffer in order). Every command must
+        end with a 'finished' message, as the config commands (alpha, kwvar,
+        kbvar, fb, useprev, seed, clamp, reset, norm, ...) do. Returns one dict
+        of the msgvar/array values reported per command and raises
+        TimeoutError if no line arrives within timeoutval seconds.
+        '''
+        messages = list(messages)
+        replies = [{} for _ in messages]
+        sent = 0
+        for i, message in enumerate(messages):
+            while sent < len(messages) and sent - i < window:
+                # no trailing newline: it would be read as part of the next command name
+                self.ser.write(messages[sent].encode())
+                sent += 1
+            while True:
+                data = self.read_safe(timeoutval = timeoutval)
+                if not data:
+                    raise TimeoutError("no acknowledgement for {!r}".format(message))
+                varname, val = self.interpret(data, suppress)
+                if varname is None:
+                    continue
+                if "finished" in varname or varname == "finalize":
+                    break
+                if val is not None:
+                    replies[i][varname] = val
+        return replies
+
+    def send_recieve(self, message, timeoutval=1000., suppress = False, settle = 1.):
         self.clear_output()
-        time.sleep(1)
+        time.sleep(settle)
         self.send_message(message)
         data = 1
         while data is not None:
@@ -99,6 +267,8 @@ class ReadWrite:
             if not data:
                 break    
             varname, val = self.interpret(data, suppress)
+            if varname is None:
+                continue
 
             if "finished" in varname:
                 break
@@ -108,9 +278,9 @@ class ReadWrite:
                 
                 
                 
-    def measure(self, timeoutval = 1000., suppress = False):
+    def measure(self, timeoutval = 1000., suppress = False, settle = 0.):
 #         self.clear_output()
-        time.sleep(1)
+        time.sleep(settle)
 #         self.send_message("random;")
         data = 1
         savedict = {}
@@ -119,6 +289,8 @@ class ReadWrite:
             if not data:
                 break    
             varname, val = self.interpret(data, suppress)
+            if varname is None:
+                continue
 
             if varname == "sending data":
                 savedict = {}
@@ -133,23 +305,115 @@ class ReadWrite:
         return savedict
     
     
-    def train_measure(self, timeoutval=1000.):
-        time.sleep(1)
+    def train_measure(self, timeoutval=1000., callback=None, threaded=False, maxsize=10000, settle=0.,
+                      log=None, keep=True):
+        ''' Records of a training run, one dict per finalized epoch.
+
+        msgvar values (epoch, aRecord, nmestimes, analogZero, ...) are ints and
+        arrays are lists, as in the records of simulation_utils.simulate_training.
+        callback is called with every record as soon as it is finalized. With
+        threaded=True the port is drained by a background thread (see iter_train_measure).
+        log appends every record to a JSON-lines file as it arrives (see
+        storage_utils.EpochLog); with keep=False records are not kept in memory
+        and None is returned.
+        '''
+        time.sleep(settle)
 #         self.clear_output()
 #         self.send_message("random;")
-        data = 1
+        if threaded:
+            records = self.iter_train_measure(timeoutval = timeoutval, maxsize = maxsize)
+        else:
+            records = self._train_records(self._read_lines(timeoutval))
+        epochlog = EpochLog(log) if log is not None else None
+        listodicts = [] if keep else None
+        try:
+            for savedict in records:
+                if epochlog is not None:
+                    epochlog(savedict)
+                if callback is not None:
+                    callback(savedict)
+                if keep:
+                    listodicts.append(savedict)
+        finally:
+            if epochlog is not None:
+                epochlog.close()
+        return listodicts
+
+    def iter_train_measure(self, timeoutval=1000., maxsize=10000):
+        ''' Iterate over the records of a training run while it is still running.
+
+        A reader thread drains the serial port into a queue of at most maxsize
+        lines, so the port keeps being emptied while the caller works on a record;
+        the lines are parsed and aggregated here, in the consuming thread.
+        '''
+        lines = queue.Queue(maxsize)
+        stop = threading.Event()
+
+        def drain():
+            while not stop.is_set():
+                data = self._read_until(stop, timeoutval)
+                while not stop.is_set():
+                    try:
+                        lines.put(data, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if not data or (data[:1] != _FRAME_BYTE and b"finished" in data):
+                    return
+
+        reader = threading.Thread(target=drain, daemon=True)
+        reader.start()
+        try:
+            for savedict in self._train_records(iter(lines.get, None)):
+                yield savedict
+        finally:
+            # the reader returns by itself after 'finished' or a timeout; if the
+            # caller stops early it returns within a poll interval, and no later
+            # command starts reading the port before it has
+            stop.set()
+            reader.join()
+
+    def _read_until(self, stop, timeoutval):
+        ''' read_safe that gives up within a poll interval of stop being set. '''
+        deadline = time.monotonic() + timeoutval
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if self.reader == 'buffered':
+                # partial lines stay in the receive buffer between the short reads
+                data = self.read_buffered(min(self.poll_interval, remaining))
+                if data is not None:
+                    return data
+            elif self.ser.in_waiting:
+                # readline loses a partial line when interrupted, so only start once a line is arriving
+                return self.read_safe(timeoutval = remaining)
+            else:
+                stop.wait(min(self.poll_interval, remaining))
+        return None
+
+    def _read_lines(self, timeoutval):
+        while True:
+            data = self.read_safe(timeoutval = timeoutval)
+            if not data:
+                return
+            yield data
+
+    def _train_records(self, lines):
         savedict = {}
-        listodicts = []
         reconstructing = False
         reconstructing_det = False
         idx = 0
         Vtest = []
         Vrecon = []
-        while data is not None:
-            data = self.read_safe(timeoutval = timeoutval)
+        for data in lines:
             if not data:
                 break    
             varname, val = self.interpret(data, suppress=True)
+            if varname is None:
+                continue
+            if isinstance(val, str):
+                val = _msgvar_value(val)
             
             if varname == "epoch":
                 print(varname, val, end='\r')
@@ -211,11 +475,10 @@ class ReadWrite:
             elif varname == "finalize":
                # print('finalize epoch')
                 #print(savedict)
-                listodicts.append(savedict)
+                yield savedict
                 savedict={}
             else:
                 savedict[varname] = val
-        return listodicts
     
     def convert(self, savedict):
         newdict = {}
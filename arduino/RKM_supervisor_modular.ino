@@ -69,6 +69,14 @@ const int other_delay = 200; //just in case!
 const int equil_delay = 1000; //for the network to equilibrate
 String buffer = "        ";
 String divider = ":";
+
+// binary frames for array messages (see serial_utils.py):
+// 0xA5 | type | name id | count (uint16) | count x int16 | checksum, little-endian
+bool binMode = false; // set with binmode;1;
+const byte frameStart = 0xA5;
+const byte frameInt16 = 0x01;
+const int numBinNames = 10;
+const char* binNames[numBinNames] = {"ki", "DA", "DB", "RA", "RB", "analogV", "analogH", "Vtest", "Vrecon", "clamped_vals"}; // name ids, same order as FRAME_NAMES
 int nmestimes = 5; // how many times to measure analog values
 
 //  --------------------- TRAINING INFO --------------------- 
@@ -178,6 +186,7 @@ void setup() {
 
 void loop() {
   String message = Serial.readStringUntil(';');
+  message.trim(); // newline left over from a previous send_message
 
   if (message == "mvtst"){
     int val = Serial.readStringUntil(';').toInt();
@@ -505,6 +514,12 @@ void loop() {
     sendMessageWithVarToPython("numProp", numProp);
     sendMessageToPython("finished");
   }
+
+  if (message == "binmode"){
+    binMode = Serial.readStringUntil(';').toInt();
+    sendMessageWithVarToPython("binmode", binMode);
+    sendMessageToPython("finished");
+  }
 }
 
 // --------------------- FUNCTIONS --------------------- 
@@ -1132,6 +1147,14 @@ void sendMessageToPython(const char* message)
 
 void send1DArrayToPython(const char* varname, int* arr, int len)
 {
+  if (binMode){
+    for (int n = 0; n < numBinNames; n++){
+      if (strcmp(varname, binNames[n]) == 0){
+        send1DArrayBinary(n, arr, len);
+        return;
+      }
+    }
+  }
   Serial.print(buffer); // buffer characters
   Serial.print(divider);
   Serial.print("1Darr");
@@ -1152,6 +1175,23 @@ void send1DArrayToPython(const char* varname, int* arr, int len)
   Serial.println(buffer);
 }
 
+void send1DArrayBinary(byte nameId, int* arr, int len)
+{
+  byte header[5] = {frameStart, frameInt16, nameId, lowByte(len), highByte(len)};
+  byte checksum = 0;
+  for (int h = 1; h < 5; h++){
+    checksum += header[h];
+  }
+  Serial.write(header, 5);
+  for (int i = 0; i < len; i++) {
+    int16_t val = arr[i]; // values must fit in int16 (k, node states, summed ADC reads)
+    byte bytes[2] = {lowByte(val), highByte(val)};
+    checksum += bytes[0] + bytes[1];
+    Serial.write(bytes, 2);
+  }
+  Serial.write(checksum);
+}
+
 // ------- Helper Functions ---------------
 
 // Helper funcion. Digital write function but faster than native digitalWrite
@@ -0,0 +1,856 @@
+''' Timing benchmarks for the circuit simulation and acquisition code.
+
+Run all benchmarks with ``python benchmarks.py`` or a single one with
+``python benchmarks.py bench_solve_many``.
+'''
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from circuit_utils import Circuit
+from Network import RKMNetwork
+
+
+def _timeit(func, repeat=5):
+    ''' Best wall time of func() over repeat calls, in seconds. '''
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _network(size, rng):
+    ''' size x size network with k values away from the zero-resistance end of the wipers. '''
+    net = RKMNetwork(size, size)
+    net.load_state({name: int(rng.integers(-127, 128)) for name in net.edge.name})
+    return net
+
+
+def bench_solve_many(sizes=(2, 4, 8), n_patterns=20, repeat=5):
+    ''' Per-pattern Circuit.solve loop against one batched Circuit.solve_many call. '''
+    print('bench_solve_many: {} patterns, clamp V'.format(n_patterns))
+    print('{:>8} {:>12} {:>12} {:>8}'.format('NVxNH', 'loop [ms]', 'batch [ms]', 'speedup'))
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        net = _network(size, rng)
+        c = Circuit(net.fullgraph)
+        conductances = net.get_conductances()
+        patterns = rng.integers(0, 2, size=(n_patterns, size))
+        clamps = [net.clamp(FB=0, vals=p) for p in patterns]
+        Q = c.constraint_matrix(clamps[0][0])
+        F = np.array([f for _, f in clamps])
+
+        def loop():
+            c.setConductances(conductances)
+            return np.array([c.solve(Q, f) for f in F])
+
+        def batch():
+            c.setConductances(conductances)
+            return c.solve_many(Q, F)
+
+        assert np.allclose(loop(), batch())
+        t_loop = _timeit(loop, repeat)
+        t_batch = _timeit(batch, repeat)
+        print('{:>8} {:>12.3f} {:>12.3f} {:>8.1f}'.format(
+            '{}x{}'.format(size, size), 1e3 * t_loop, 1e3 * t_batch, t_loop / t_batch))
+
+
+def bench_reduced_solve(sizes=(8, 32, 64, 128, 256), n_patterns=20, repeat=3):
+    ''' Saddle-point against reduced (Schur complement) solves as the network grows. '''
+    methods = ('saddle', 'reduced', 'cg')
+    print('bench_reduced_solve: factorize + {} patterns, clamp V'.format(n_patterns))
+    print('{:>8} {:>6} {:>7}'.format('NVxNH', 'n', 'ne') +
+          ''.join('{:>14}'.format(m + ' [ms]') for m in methods))
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        net = RKMNetwork(size, size)
+        c = Circuit(net.fullgraph)
+        conductances = 1. / (1e5 * (1 - rng.integers(0, 128, size=c.ne) / 128.))
+        patterns = rng.integers(0, 2, size=(n_patterns, size))
+        clamps = [net.clamp(FB=0, vals=p) for p in patterns]
+        Q = c.constraint_matrix(clamps[0][0])
+        F = np.array([f for _, f in clamps])
+
+        times = []
+        V = {}
+        for method in methods:
+
+            def run():
+                c.setConductances(conductances)
+                V[method] = c.solve_many(Q, F, method=method)
+
+            times.append(_timeit(run, repeat))
+        for method in methods[1:]:
+            assert np.allclose(V[method], V['saddle'])
+        print('{:>8} {:>6} {:>7}'.format('{}x{}'.format(size, size), c.n, c.ne) +
+              ''.join('{:>14.3f}'.format(1e3 * t) for t in times))
+
+
+def bench_clamp_solve(sizes=(2, 4, 8, 16, 32, 64), repeat=5):
+    ''' Per-call overhead of RKMNetwork.clamp_solve with a fresh Circuit against the cached one. '''
+    print('bench_clamp_solve: one clamp_solve call, clamp V')
+    print('{:>8} {:>14} {:>14} {:>8}'.format('NVxNH', 'fresh [ms]', 'cached [ms]', 'speedup'))
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        net = _network(size, rng)
+        vals = rng.integers(0, 2, size=size)
+
+        def fresh():
+            net._circuit = None
+            return net.clamp_solve(FB=0, vals=vals, plot=False)
+
+        def cached():
+            return net.clamp_solve(FB=0, vals=vals, plot=False)
+
+        t_fresh = _timeit(fresh, repeat)
+        cached()
+        t_cached = _timeit(cached, repeat)
+        print('{:>8} {:>14.3f} {:>14.3f} {:>8.1f}'.format(
+            '{}x{}'.format(size, size), 1e3 * t_fresh, 1e3 * t_cached, t_fresh / t_cached))
+
+
+def _training_transcript(epochs=200, seed=0, size=2, binary=False):
+    ''' Serial transcript of a simulated size x size training run. '''
+    from serial_utils import transcript_from_records
+    from simulation_utils import simulate_training
+    data = np.eye(2, size, dtype=int)
+    records = simulate_training(RKMNetwork(size, size), data, epochs,
+                                det_inference=True, seed=seed)[0]
+    return transcript_from_records(records, binary=binary)
+
+
+def bench_run_ensemble(n_seeds=8, epochs=50, size=2):
+    ''' Simulated training ensemble: simulate_training per task in a loop against run_ensemble in a process pool. '''
+    from simulation_utils import iter_ensemble, run_ensemble, simulate_training
+    net = RKMNetwork(size, size)
+    data = np.eye(2, size, dtype=int)
+    k0 = net.get_ks()
+    # unhashable grid values and a repeated grid point
+    grid = [{'k_init': k0, 'alpha': 1}, {'k_init': k0, 'alpha': 1}, {'k_init': [0] * len(k0), 'alpha': 2}]
+    seeds = range(n_seeds)
+
+    def serial():
+        return [(seed, params, simulate_training(net, data, epochs, seed=seed, **params))
+                for params in grid for seed in seeds]
+
+    def pooled():
+        return run_ensemble(net, data, epochs, grid, seeds)
+
+    expected = serial()
+    results = pooled()
+    assert len(results) == len(expected)
+    for (seed, params, records), (seed_e, params_e, records_e) in zip(results, expected):
+        assert seed == seed_e and all(np.array_equal(params[key], params_e[key]) for key in params_e)
+        assert all(a['ki'] == b['ki'] for a, b in zip(records[0], records_e[0]))
+
+    def first():
+        # stopping early cancels the tasks that have not started
+        for result in iter_ensemble(net, data, epochs, grid, seeds, max_workers=1):
+            return result
+
+    print('bench_run_ensemble: {0}x{0}, {1} tasks of {2} epochs'.format(size, len(grid) * n_seeds, epochs))
+    print('{:>22} {:>10}'.format('', 'wall [s]'))
+    times = [_timeit(run, repeat=1) for run in (serial, pooled, first)]
+    assert times[2] < times[1] / 2
+    for label, t in zip(('simulate_training loop', 'run_ensemble', 'first, 1 worker'), times):
+        print('{:>22} {:>10.3f}'.format(label, t))
+
+
+def bench_serial_reader(epochs=200):
+    ''' ReadWrite.read_safe over a recorded training transcript: func_timeout thread per line against the buffered reader. '''
+    from ReadWrite import ReadWrite
+    from serial_utils import FakeSerial
+    transcript = _training_transcript(epochs)
+    n_lines = transcript.count(b'\n')
+    print('bench_serial_reader: {} lines ({} epochs)'.format(n_lines, epochs))
+    print('{:>10} {:>10} {:>10} {:>12}'.format('reader', 'wall [s]', 'cpu [s]', 'lines/s'))
+    for reader in ('thread', 'buffered'):
+        rw = ReadWrite(FakeSerial(transcript), reader=reader)
+        lines = []
+        t0, c0 = time.perf_counter(), time.process_time()
+        line = rw.read_safe(timeoutval=1.)
+        while line is not None and b'finished' not in line:
+            lines.append(line)
+            line = rw.read_safe(timeoutval=1.)
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        assert len(lines) + 1 == n_lines
+        print('{:>10} {:>10.3f} {:>10.3f} {:>12.0f}'.format(reader, wall, cpu, n_lines / wall))
+
+
+def _literal_eval_interpret(byteval, divider=':'):
+    # the ast.literal_eval based ReadWrite.interpret, for comparison
+    import ast
+    messages = byteval.decode('utf-8').split('\r')[0].split(divider)
+    if messages[1] == 'msg':
+        return messages[2], None
+    if messages[1] == 'msgvar':
+        return messages[2], messages[3]
+    return messages[2], ast.literal_eval(messages[3])
+
+
+def bench_stop_train_measure(epochs=20):
+    ''' Breaking out of iter_train_measure while the port is quiet: time to return, and the next command gets its own reply. '''
+    from ReadWrite import ReadWrite
+    from serial_utils import FakeRKMDevice, FakeSerial, format_msg
+    transcript = _training_transcript(epochs)
+    # the run is still going: no 'finished' yet
+    transcript = transcript[:-len(format_msg('finished'))]
+    print('bench_stop_train_measure: {} epochs, then an alpha command'.format(epochs))
+    print('{:>10} {:>12}'.format('reader', 'stop [ms]'))
+    for reader in ('thread', 'buffered'):
+        rw = ReadWrite(FakeSerial(transcript, responder=FakeRKMDevice()), reader=reader)
+        records = rw.iter_train_measure(timeoutval=10.)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, record in enumerate(records):
+                if i == epochs:
+                    break
+        # the reader is now waiting on the quiet port
+        time.sleep(0.05)
+        t0 = time.perf_counter()
+        records.close()
+        stop = time.perf_counter() - t0
+        assert rw.command('alpha;2;', timeoutval=1.) == {'alpha': '2'}
+        print('{:>10} {:>12.1f}'.format(reader, 1e3 * stop))
+
+
+def bench_line_parser(epochs=200, repeat=3):
+    ''' ReadWrite.interpret over every line of a training transcript against the ast.literal_eval parser. '''
+    from ReadWrite import ReadWrite
+    lines = _training_transcript(epochs).splitlines(keepends=True)
+    arrays = [line for line in lines if b':1Darr:' in line]
+    rw = ReadWrite()
+    for line in lines:
+        assert rw.interpret(line, suppress=True) == _literal_eval_interpret(line)
+    print('bench_line_parser: {} lines, {} arrays ({} epochs)'.format(len(lines), len(arrays), epochs))
+    print('{:>14} {:>12} {:>14}'.format('parser', 'all [ms]', 'arrays [us/line]'))
+    for label, parse in (('literal_eval', _literal_eval_interpret),
+                         ('interpret', lambda line: rw.interpret(line, suppress=True)),
+                         ('parse_line', rw.parse_line)):
+        t_all = _timeit(lambda: [parse(line) for line in lines], repeat)
+        t_arr = _timeit(lambda: [parse(line) for line in arrays], repeat)
+        print('{:>14} {:>12.2f} {:>14.2f}'.format(label, 1e3 * t_all, 1e6 * t_arr / len(arrays)))
+
+
+def bench_binary_frames(sizes=(2, 4, 8), epochs=50):
+    ''' ASCII lines against binary frames: bytes on the wire and host decode time of a training run, through a FakeSerial loopback. '''
+    from ReadWrite import ReadWrite
+    import threading
+    from serial_utils import FRAME_INT16, FRAME_START, FakeSerial, encode_frame, format_msgvar
+    baud = 250000
+    print('bench_binary_frames: {} epochs, {} baud (10 bits per byte)'.format(epochs, baud))
+    print('{:>8} {:>8} {:>12} {:>12} {:>12}'.format('NVxNH', 'mode', 'bytes', 'wire [s]', 'decode [s]'))
+    for size in sizes:
+        results = {}
+        for mode in ('ascii', 'binary'):
+            transcript = _training_transcript(epochs, size=size, binary=(mode == 'binary'))
+            rw = ReadWrite(FakeSerial(transcript), reader='buffered')
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[mode] = list(rw._train_records(rw._read_lines(timeoutval=1.)))
+            decode = time.perf_counter() - t0
+            print('{:>8} {:>8} {:>12} {:>12.2f} {:>12.3f}'.format(
+                '{}x{}'.format(size, size), mode, len(transcript), 10. * len(transcript) / baud, decode))
+        # a corrupt frame (a start byte and a garbage count) in front of every
+        # epoch: the reader drops it and picks up the frames and lines after it
+        corrupt = bytes([FRAME_START, FRAME_INT16, 0, 0x00, 0xF0, 1, 2]) + b'\r\n'
+        epoch = format_msgvar('epoch', 0).split(b'0')[0]
+        rw = ReadWrite(FakeSerial(transcript.replace(epoch, corrupt + epoch)), reader='buffered')
+        with contextlib.redirect_stdout(io.StringIO()):
+            results['corrupt'] = list(rw._train_records(rw._read_lines(timeoutval=.1)))
+        assert len(results['ascii']) == len(results['corrupt']) == epochs + 1
+        for a, b, c in zip(results['ascii'], results['binary'], results['corrupt']):
+            assert a.keys() == b.keys() == c.keys()
+            assert all(np.array_equal(a[key], b[key]) and np.array_equal(a[key], c[key]) for key in a)
+
+    # a valid frame split over two writes further apart than the poll interval
+    # is kept across the short reads until it is complete
+    frame = encode_frame('ki', np.arange(-20, 20))
+    port = FakeSerial()
+    rw = ReadWrite(port, reader='buffered')
+    writer = threading.Timer(0.03, port.feed, (frame[4:],))
+    port.feed(frame[:4])
+    writer.start()
+    line = None
+    for _ in range(50):
+        line = rw.read_safe(timeoutval=rw.poll_interval)
+        if line is not None:
+            break
+    writer.join()
+    assert line == frame, line
+
+
+def bench_command_setup(latency=0.005):
+    ''' Config commands of one training trial: send_recieve with the notebook's sleeps against ReadWrite.commands. '''
+    from ReadWrite import ReadWrite
+    from serial_utils import FakeRKMDevice, FakeSerial
+    setup = ['alpha;1;', 'kwvar;20;', 'kbvar;5;', 'seed;1;17;', 'seed;2;42;',
+             'fb;0;', 'useprev;0;', 'clamp;0;0;', 'reset;', 'norm;']
+    print('bench_command_setup: {} commands, {:.0f} ms device latency each'.format(len(setup), 1e3 * latency))
+    print('{:>22} {:>10}'.format('', 'wall [s]'))
+
+    def legacy():
+        rw = ReadWrite(FakeSerial(responder=FakeRKMDevice(latency=latency), timeout=0.), reader='buffered')
+        with contextlib.redirect_stdout(io.StringIO()):
+            for message in setup:
+                rw.send_recieve(message)
+                time.sleep(1)
+
+    def acknowledged():
+        device = FakeRKMDevice(latency=latency)
+        rw = ReadWrite(FakeSerial(responder=device, timeout=0.), reader='buffered')
+        rw.commands(setup)
+        assert device.state['kwvar'] == 20 and device.state['seed'] == 42
+
+    for label, run in (('send_recieve + sleep', legacy), ('commands', acknowledged)):
+        print('{:>22} {:>10.3f}'.format(label, _timeit(run, repeat=1)))
+
+
+def _fake_train_measure(records, binary=False):
+    ''' Records ReadWrite.train_measure reads from a FakeRKMDevice that plays back records. '''
+    from ReadWrite import ReadWrite
+    from serial_utils import FakeRKMDevice, FakeSerial
+    rw = ReadWrite(FakeSerial(responder=FakeRKMDevice(records=records), timeout=0.), reader='buffered')
+    if binary:
+        rw.command('binmode;1;')
+    rw.ser.write('train;{};'.format(len(records) - 1).encode())
+    with contextlib.redirect_stdout(io.StringIO()):
+        return rw.train_measure(timeoutval=1.)
+
+
+def bench_fake_training(epochs=100, size=2):
+    ''' A simulated training run played back by FakeRKMDevice through ReadWrite.train_measure, ASCII lines against binary frames. '''
+    from simulation_utils import simulate_training
+    data = np.eye(2, size, dtype=int)
+    t0 = time.perf_counter()
+    simulated = simulate_training(RKMNetwork(size, size), data, epochs, det_inference=True, seed=0)[0]
+    t_sim = time.perf_counter() - t0
+    print('bench_fake_training: {0}x{0}, {1} epochs, simulated in {2:.3f} s'.format(size, epochs, t_sim))
+    print('{:>8} {:>10}'.format('mode', 'wall [s]'))
+    for binary in (False, True):
+        t0 = time.perf_counter()
+        measured = _fake_train_measure(simulated, binary)
+        wall = time.perf_counter() - t0
+        print('{:>8} {:>10.3f}'.format('binary' if binary else 'ascii', wall))
+        # the records of both sides hold the same values with the same types (the
+        # firmware does not send trainingstep, nor the initial ki and epoch; the
+        # measured records also keep the plain messages, with value None)
+        assert len(measured) == len(simulated)
+        for i, (sim, meas) in enumerate(zip(simulated, measured)):
+            assert set(sim) - set(meas) == ({'trainingstep'} if i else {'trainingstep', 'ki', 'epoch'})
+            for key in set(sim) & set(meas):
+                assert meas[key] == sim[key] and type(meas[key]) is type(sim[key]), key
+        sim_df = pd.DataFrame(simulated[1:])
+        meas_df = pd.DataFrame(measured[1:])
+        common = sim_df.columns.intersection(meas_df.columns)
+        assert (sim_df[common].dtypes == meas_df[common].dtypes).all()
+
+
+def bench_trajectory_load(directory='data/trainings/NV2NH2_10mV_011426', repeat=3):
+    ''' Loading a training ensemble: pd.read_csv + literal_eval of Vtest/Vrecon against the columnar .npy format. '''
+    import ast
+    import glob
+    import os
+    import shutil
+    import tempfile
+    import storage_utils
+    csvs = sorted(glob.glob(os.path.join(directory, 'train*.csv')))
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = [storage_utils.convert_csv(csv, os.path.join(tmp, os.path.basename(csv)[:-4])) for csv in csvs]
+        csv_bytes = sum(os.path.getsize(csv) for csv in csvs)
+        npy_bytes = sum(os.path.getsize(os.path.join(p, f)) for p in paths for f in os.listdir(p))
+
+        def from_csv():
+            dfs = []
+            for csv in csvs:
+                df = pd.read_csv(csv)
+                df['Vtest'] = [np.array(ast.literal_eval(v)) for v in df['Vtest']]
+                df['Vrecon'] = [np.array(ast.literal_eval(v)) for v in df['Vrecon']]
+                dfs.append(df)
+            return dfs
+
+        # round trip of the records train_measure reads from the port, with the
+        # msgvar columns also as the strings older records hold
+        from simulation_utils import simulate_training
+        simulated = simulate_training(RKMNetwork(2, 2), np.eye(2, dtype=int), 20, det_inference=True, seed=0)[0]
+        measured = pd.DataFrame(_fake_train_measure(simulated)[1:])
+        # without the columns of the plain messages, which hold None
+        measured = measured[[c for c in measured.columns if measured[c].notna().all()]]
+        path = os.path.join(tmp, 'records')
+        for df in (measured, measured.astype({'epoch': str, 'analogZero': str})):
+            storage_utils.save_trajectory(path, df)
+            stored = storage_utils.load_trajectory(path)
+            assert list(stored.columns) == list(measured.columns)
+            for name in measured.columns:
+                assert stored[name].dtype == measured[name].dtype or name in storage_utils.ARRAY_COLUMNS
+                assert all(np.array_equal(a, b) for a, b in zip(stored[name], measured[name])), name
+
+        dfs = from_csv()
+        for df, p in zip(dfs, paths):
+            stored = storage_utils.load_trajectory(p)
+            assert np.array_equal(np.stack(df['Vrecon']), np.stack(stored['Vrecon']))
+            assert np.allclose(df['MSE'], stored['MSE'])
+
+        print('bench_trajectory_load: {} trials, {:.0f} kB csv, {:.0f} kB npy'.format(
+            len(csvs), csv_bytes / 1e3, npy_bytes / 1e3))
+        print('{:>26} {:>10}'.format('', 'wall [ms]'))
+        for label, load in (('read_csv + literal_eval', from_csv),
+                            ('load_trajectory', lambda: [storage_utils.load_trajectory(p) for p in paths]),
+                            ('load_arrays', lambda: [storage_utils.load_arrays(p) for p in paths])):
+            print('{:>26} {:>10.2f}'.format(label, 1e3 * _timeit(load, repeat)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_ensemble_stats(directory='data/trainings/NV2NH2_10mV_011426', copies=40, repeat=1):
+    ''' Per-epoch mean/std MSE of an ensemble: concatenated CSVs in pandas against a streaming TrainingEnsemble. '''
+    import glob
+    import os
+    import shutil
+    import tempfile
+    import tracemalloc
+    import storage_utils
+    csvs = sorted(glob.glob(os.path.join(directory, 'train*.csv')))
+    tmp = tempfile.mkdtemp()
+    try:
+        # replicate the recorded trials into a larger ensemble
+        for i, csv in enumerate(csvs):
+            path = storage_utils.convert_csv(csv, os.path.join(tmp, 'npy', 'train{:04d}'.format(i)))
+            shutil.copy(csv, os.path.join(tmp, 'train{:04d}.csv'.format(i)))
+            for c in range(1, copies):
+                j = c * len(csvs) + i
+                shutil.copytree(path, os.path.join(tmp, 'npy', 'train{:04d}'.format(j)))
+                shutil.copy(csv, os.path.join(tmp, 'train{:04d}.csv'.format(j)))
+        n_trials = copies * len(csvs)
+
+        def concat():
+            df = pd.concat([pd.read_csv(csv) for csv in sorted(glob.glob(os.path.join(tmp, 'train*.csv')))])
+            grouped = df.groupby('trainingstep')['MSE']
+            return grouped.mean().to_numpy(), grouped.std(ddof=0).to_numpy()
+
+        def streaming():
+            return storage_utils.TrainingEnsemble(os.path.join(tmp, 'npy')).stats('MSE')
+
+        assert all(np.allclose(a, b) for a, b in zip(concat(), streaming()))
+        print('bench_ensemble_stats: {} trials'.format(n_trials))
+        print('{:>18} {:>10} {:>14}'.format('', 'wall [ms]', 'peak mem [MB]'))
+        for label, run in (('pandas concat', concat), ('TrainingEnsemble', streaming)):
+            t = _timeit(run, repeat)
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:>18} {:>10.1f} {:>14.2f}'.format(label, 1e3 * t, peak / 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_epoch_log(epochs=(100, 400)):
+    ''' Memory held by ReadWrite.train_measure keeping all records against streaming them to an EpochLog. '''
+    import os
+    import tempfile
+    import tracemalloc
+    from ReadWrite import ReadWrite
+    from serial_utils import FakeSerial
+    from storage_utils import read_epoch_log
+    print('bench_epoch_log: 2x2 training transcript')
+    print('{:>8} {:>16} {:>12} {:>14}'.format('epochs', 'mode', 'wall [s]', 'held [MB]'))
+    tmp = tempfile.mkdtemp()
+    for n in epochs:
+        transcript = _training_transcript(n)
+        for label, kwargs in (('keep', {}), ('log, keep=False', {'keep': False})):
+            path = os.path.join(tmp, '{}_{}.jsonl'.format(n, len(kwargs)))
+            if kwargs:
+                kwargs['log'] = path
+            rw = ReadWrite(FakeSerial(transcript), reader='buffered')
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                records = rw.train_measure(timeoutval=1., **kwargs)
+            wall = time.perf_counter() - t0
+            # the transcript was consumed from the port, what is left is what the caller holds
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del records
+            print('{:>8} {:>16} {:>12.3f} {:>14.2f}'.format(n, label, wall, held / 1e6))
+        assert len(read_epoch_log(path)) == n + 1
+        os.remove(path)
+    os.rmdir(tmp)
+
+
+def bench_metrics(n_trials=20, n_rows=2000, numtest=20, NV=2, lam=20., repeat=3):
+    ''' Notebook row loop (per-row norm, one spline per trial) against the batched metrics_utils functions. '''
+    import metrics_utils
+    from scipy.interpolate import make_smoothing_spline
+    rng = np.random.default_rng(0)
+    shape = (n_trials, n_rows, numtest, NV)
+    columns = {name: rng.integers(0, 2, size=shape, dtype=np.int8)
+               for name in ('Vtest', 'Vrecon', 'Vtest_det', 'Vrecon_det')}
+    steps = np.arange(n_rows)
+
+    def loop():
+        MSEs, MSEdet, smoothed = [], [], []
+        for t in range(n_trials):
+            MSE = [np.mean(np.linalg.norm(np.array(columns['Vtest'][t, i]).T - np.array(columns['Vrecon'][t, i]).T, axis=0))
+                   for i in range(n_rows)]
+            MSEdet.append([np.mean(np.linalg.norm(np.array(columns['Vtest_det'][t, i]).T - np.array(columns['Vrecon_det'][t, i]).T, axis=0))
+                           for i in range(n_rows)])
+            MSEs.append(MSE)
+            smoothed.append(make_smoothing_spline(steps, MSE, lam=lam)(steps))
+        return np.array(MSEs), np.array(smoothed)
+
+    def batched():
+        metrics = metrics_utils.trajectory_metrics(columns)
+        return metrics['MSE'], metrics_utils.smooth(steps, metrics['MSE'], lam=lam)
+
+    for a, b in zip(loop(), batched()):
+        assert np.allclose(a, b)
+    print('bench_metrics: {} trials x {} rows, {} test patterns of {} bits'.format(n_trials, n_rows, numtest, NV))
+    print('{:>10} {:>10}'.format('', 'wall [ms]'))
+    for label, run in (('row loop', loop), ('batched', batched)):
+        print('{:>10} {:>10.1f}'.format(label, 1e3 * _timeit(run, repeat)))
+
+
+def bench_topology(sizes=(8, 32, 64, 128, 256), repeat=3):
+    ''' Building an RKMNetwork from index arrays, its circuit, and (on request) the networkx full graph. '''
+    print('bench_topology: RKMNetwork(n, n)')
+    print('{:>8} {:>8} {:>14} {:>14} {:>16}'.format('NVxNH', 'edges', 'build [ms]', 'circuit [ms]', 'fullgraph [ms]'))
+    for size in sizes:
+        net = RKMNetwork(size, size)
+        assert net.edge.name.is_unique
+
+        def circuit():
+            net._circuit = None
+            return net.circuit
+
+        def fullgraph():
+            net._fullgraph = None
+            return net.fullgraph
+
+        times = [_timeit(lambda: RKMNetwork(size, size), repeat), _timeit(circuit, repeat),
+                 _timeit(fullgraph, 1)]
+        print('{:>8} {:>8} {:>14.1f} {:>14.1f} {:>16.1f}'.format(
+            '{}x{}'.format(size, size), len(net.edge), *(1e3 * t for t in times)))
+
+
+def bench_dense_threshold(sizes=(1, 2, 4, 8, 12, 16, 24, 32, 48, 64, 96, 128), n_patterns=20, repeat=5):
+    ''' setConductances + solve_many with the dense and sparse backends, to calibrate Circuit.DENSE_MAX_NODES. '''
+    methods = ('saddle', 'reduced', 'dense')
+    print('bench_dense_threshold: setConductances + {} patterns, clamp V'.format(n_patterns))
+    print('{:>8} {:>6}'.format('NVxNH', 'n') + ''.join('{:>14}'.format(m + ' [ms]') for m in methods))
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        net = _network(size, rng)
+        c = net.circuit
+        conductances = net.get_conductances()
+        indices, F = net.clamp_patterns(FB=0, patterns=rng.integers(0, 2, size=(n_patterns, size)))
+        Q = c.constraint_matrix(indices)
+        V = {}
+        times = []
+        for method in methods:
+
+            def run():
+                c.setConductances(conductances)
+                V[method] = c.solve_many(Q, F, method=method)
+
+            times.append(_timeit(run, repeat))
+        assert all(np.allclose(V[m], V['saddle']) for m in methods)
+        print('{:>8} {:>6}'.format('{}x{}'.format(size, size), c.n) +
+              ''.join('{:>14.3f}'.format(1e3 * t) for t in times))
+
+
+def bench_trajectory_solve(path='data/trainings/NV2NH2_10mV_011426/train00.csv', repeat=3):
+    ''' Node voltages at every epoch of a recorded trajectory: clamp_solve per epoch and pattern against one clamp_solve_states call. '''
+    df = pd.read_csv(path)
+    net = RKMNetwork(2, 2)
+    # recorded wipers at -128 would short a leg
+    ks = np.clip(net.load_states(df), -127, 127)
+    patterns = np.array([[1, 0], [0, 1]])
+
+    def loop():
+        V = np.empty((len(ks), len(patterns), net.circuit.n))
+        for i, k in enumerate(ks):
+            net.load_state(dict(zip(net.edge.name, k)))
+            for j, p in enumerate(patterns):
+                V[i, j] = list(net.clamp_solve(FB=0, vals=p, plot=False).values())
+        return V
+
+    def batched():
+        return net.clamp_solve_states(ks, FB=0, patterns=patterns)
+
+    assert np.allclose(loop(), batched())
+    print('bench_trajectory_solve: {} epochs x {} patterns, 2x2'.format(len(ks), len(patterns)))
+    print('{:>22} {:>10}'.format('', 'wall [ms]'))
+    for label, run in (('clamp_solve loop', loop), ('clamp_solve_states', batched)):
+        print('{:>22} {:>10.2f}'.format(label, 1e3 * _timeit(run, repeat)))
+
+
+def bench_replay(directory='data/trainings/NV2NH2_10mV_011426', repeat=3):
+    ''' Model predictions of the logged node measurements of a trial ensemble: clamp_solve per row against one replay call. '''
+    import glob
+    import os
+
+    paths = sorted(glob.glob(os.path.join(directory, 'train*.csv')))
+    df = pd.concat([pd.read_csv(p) for p in paths], ignore_index=True)
+    net = RKMNetwork(2, 2)
+    V = ['V0', 'V1']
+    H = ['H0', 'H1']
+    pred = net.replay(df)
+    # rows without measurements (initial states) or with a shorted leg
+    valid = pred.notna().all(axis=1).to_numpy()
+
+    def loop():
+        rows = []
+        for _, row in df[valid].iterrows():
+            net.load_state(row)
+            D = net.clamp_solve(FB=0, vals=row[['D' + n for n in V]].astype(int), plot=False)
+            B = net.clamp_solve(FB=1, vals=row[['D' + n for n in H]].astype(int), plot=False)
+            F = net.clamp_solve(FB=0, vals=row[['R' + n for n in V]].astype(int), plot=False)
+            rows.append([D[n + '+'] > 2. for n in H] + [B[n + '+'] for n in V]
+                        + [F[n + '+'] for n in H] + [F[n + '+'] > 2. for n in H])
+        return pd.DataFrame(rows, columns=pred.columns, dtype=float)
+
+    def batched():
+        return net.replay(df)
+
+    # states may differ where a voltage sits at aZero up to rounding, compare the voltages
+    analog = ['aV0', 'aV1', 'aH0', 'aH1']
+    assert np.allclose(loop()[analog], pred[valid][analog])
+    residual = df[pred.columns] - pred
+    print('bench_replay: {} trials, {} rows, 2x2'.format(len(paths), len(df)))
+    print('{:>22} {:>10}'.format('', 'wall [ms]'))
+    for label, run in (('clamp_solve loop', loop), ('replay', batched)):
+        print('{:>22} {:>10.2f}'.format(label, 1e3 * _timeit(run, repeat)))
+    print('mean |residual|: ' + ', '.join('{} {:.3f}'.format(c, v) for c, v in residual.abs().mean().items()))
+
+
+def bench_beta_sweep(sizes=(2, 8), n_betas=30, n_trials=20, numtest=20, repeat=3):
+    ''' Error-vs-beta curve of one k state: _RKMModel.reconstruct per beta against one sample_reconstructions call. '''
+    import metrics_utils
+    from simulation_utils import _RKMModel, sample_reconstructions
+    rng = np.random.default_rng(0)
+    betas = list(np.geomspace(4., 999., n_betas - 1)) + [None]
+    print('bench_beta_sweep: {} betas x {} trials x {} test patterns'.format(n_betas, n_trials, numtest))
+    print('{:>6} {:>14} {:>14} {:>10}'.format('size', 'loop [ms]', 'batched [ms]', 'max |dMSE|'))
+    for size in sizes:
+        net = _network(size, rng)
+        k = net.get_ks()
+        Vtest = rng.integers(0, 2, size=(numtest, size))
+        model = _RKMModel(net)
+
+        def loop():
+            # as simulate_training: one batched solve per beta over trials x patterns
+            G = np.repeat(net.get_conductances(k)[None], n_trials * numtest, axis=0)
+            flat = np.tile(Vtest, (n_trials, 1))
+            return np.array([model.reconstruct(flat, G, beta, rng).reshape(n_trials, numtest, size)
+                             for beta in betas])
+
+        def batched():
+            return sample_reconstructions(net, k, Vtest, betas, n_trials=n_trials, seed=0)
+
+        a, b = loop(), batched()
+        assert np.array_equal(a[-1], b[-1])
+        # sampled curves agree up to the sampling noise
+        gap = np.max(np.abs(metrics_utils.mse(Vtest, a).mean(1) - metrics_utils.mse(Vtest, b).mean(1)))
+        print('{:>6} {:>14.1f} {:>14.1f} {:>10.3f}'.format(
+            '{0}x{0}'.format(size), 1e3 * _timeit(loop, repeat), 1e3 * _timeit(batched, repeat), gap))
+
+
+def bench_edge_updates(sizes=(8, 16, 32), repeat=3):
+    ''' One epoch of sequential single-edge k changes, solved after every change: refactorization against update_conductances. '''
+    rng = np.random.default_rng(0)
+    print('bench_edge_updates: every edge changes by one step in a random order, one clamp solve per change')
+    print('{:>6} {:>6} {:>14} {:>14} {:>10}'.format('size', 'edges', 'refactor [ms]', 'update [ms]', 'max |dV|'))
+    for size in sizes:
+        net = _network(size, rng)
+        c = net.circuit
+        k0 = np.clip(net.get_ks(), -126, 126)
+        order = rng.permutation(len(k0))
+        steps = rng.choice([-1, 1], size=len(k0))
+        indices_nodes, f = net.clamp(FB=0, vals=rng.integers(0, 2, size=size))
+        Q = c.constraint_matrix(indices_nodes)
+        # conductances of every full-graph edge at every k value, and the legs
+        # of every edge, so a step only looks up the two changed conductances
+        table = net.get_conductances(np.repeat(np.arange(-127, 128)[:, None], len(k0), axis=1))
+        legs = [np.flatnonzero(net._fulledge_index == e) for e in range(len(k0))]
+
+        def epoch(update):
+            k = k0.copy()
+            G = net.get_conductances(k)
+            c.setConductances(G.copy())
+            c.solve(Q, f)
+            for e in order:
+                k[e] += steps[e]
+                G[legs[e]] = table[k[e] + 127, legs[e]]
+                if update:
+                    c.update_conductances(legs[e], G[legs[e]])
+                else:
+                    c.setConductances(G.copy())
+                V = c.solve(Q, f)
+            assert np.array_equal(G, net.get_conductances(k))
+            return V
+
+        gap = np.max(np.abs(epoch(True) - epoch(False)))
+        print('{:>6} {:>6} {:>14.1f} {:>14.1f} {:>10.1e}'.format(
+            '{0}x{0}'.format(size), len(k0), 1e3 * _timeit(lambda: epoch(False), repeat),
+            1e3 * _timeit(lambda: epoch(True), repeat), gap))
+
+
+def bench_sensitivity(sizes=(4, 8, 16), repeat=3):
+    ''' dV/dk of a clamped circuit: finite differences (one clamp_solve per edge) against clamp_sensitivity. '''
+    rng = np.random.default_rng(0)
+    print('bench_sensitivity: Jacobian of the node voltages with respect to every k, clamp V')
+    print('{:>6} {:>6} {:>14} {:>14} {:>10}'.format('size', 'edges', 'fin. diff [ms]', 'adjoint [ms]', 'rel. err'))
+    for size in sizes:
+        net = _network(size, rng)
+        # away from k = 0 and the wiper ends, where the map g(k) has kinks
+        k = np.clip(net.get_ks(), -120, 120)
+        k[k == 0] = 1
+        net.load_state(dict(zip(net.edge.name, k)))
+        vals = rng.integers(0, 2, size=size)
+        c = net.circuit
+        indices_nodes, f = net.clamp(FB=0, vals=vals)
+        Q = c.constraint_matrix(indices_nodes)
+        h = 1e-3
+
+        def finite_differences():
+            # get_conductances of non-integer k, one solve per edge
+            c.setConductances(net.get_conductances(k))
+            V0 = c.solve(Q, f)
+            J = np.empty((len(V0), len(k)))
+            for e in range(len(k)):
+                kh = k.astype(float)
+                kh[e] += h
+                c.setConductances(net.get_conductances(kh))
+                J[:, e] = (c.solve(Q, f) - V0) / h
+            return J
+
+        def adjoint():
+            return net.clamp_sensitivity(FB=0, vals=vals)
+
+        J = adjoint()
+        err = np.abs(finite_differences() - J).max() / np.abs(J).max()
+        print('{:>6} {:>6} {:>14.1f} {:>14.1f} {:>10.1e}'.format(
+            '{0}x{0}'.format(size), len(k), 1e3 * _timeit(finite_differences, repeat),
+            1e3 * _timeit(adjoint, repeat), err))
+
+
+def bench_calibration(directory='data/trainings/NV2NH2_10mV_011426', repeat=3):
+    ''' Calibration fit of a trial ensemble: analytic against finite-difference Jacobians, and the full fit. '''
+    import glob
+    import os
+    from calibration_utils import _CalibrationProblem, fit_calibration
+
+    trajectories = [pd.read_csv(p) for p in sorted(glob.glob(os.path.join(directory, 'train*.csv')))]
+    net = RKMNetwork(2, 2)
+    problem = _CalibrationProblem(net, pd.concat(trajectories, ignore_index=True), 0.1)
+    x = problem.x_ideal
+
+    def analytic():
+        problem._cache = (None, None, None)
+        return problem.jacobian(x)
+
+    def finite_differences():
+        # one residual evaluation per parameter, as least_squares(jac='2-point')
+        r0 = problem.residuals(x)
+        J = np.empty((len(r0), len(x)))
+        for i in range(len(x)):
+            h = 1e-8 * max(1., abs(x[i]))
+            xh = x.copy()
+            xh[i] += h
+            J[:, i] = (problem.residuals(xh) - r0) / h
+        return J
+
+    assert np.allclose(analytic(), finite_differences(), atol=1e-6)
+    print('bench_calibration: {} trials, {} rows, {} parameters'.format(len(trajectories), problem.n_rows, len(x)))
+    print('{:>22} {:>10}'.format('jacobian', 'wall [ms]'))
+    for label, run in (('finite differences', finite_differences), ('analytic', analytic)):
+        print('{:>22} {:>10.1f}'.format(label, 1e3 * _timeit(run, repeat)))
+    t0 = time.perf_counter()
+    calibration = fit_calibration(net, trajectories)
+    n_measured = len(calibration.result.fun) - len(x)
+    rms = [np.sqrt(np.mean(r[:n_measured] ** 2)) for r in (problem.residuals(x), calibration.result.fun)]
+    print('fit: {:.1f} s, {} evaluations, rms residual {:.1f} mV (ideal model {:.1f} mV)'.format(
+        time.perf_counter() - t0, calibration.result.nfev, 1e3 * rms[1], 1e3 * rms[0]))
+
+
+def _check_blitted_frames(renderer):
+    ''' Assert that blitted frames, with and without the slider, match full redraws of the same frames. '''
+    canvas = renderer.fig.canvas
+    # the frames of the animation, drawn the way it plays them, match the blitted ones
+    anim = renderer.animation()
+    # the first draw starts it, as showing the figure would
+    canvas.draw()
+    for i in (renderer.n_frames - 1, 0):
+        anim._draw_next_frame(i, anim._blit)
+        canvas.draw()
+        drawn = np.array(canvas.buffer_rgba())
+        renderer.show_frame(i)
+        assert np.array_equal(drawn, np.array(canvas.buffer_rgba())), 'animation frame {} differs'.format(i)
+    anim.pause()
+    for scrub in (False, True):
+        if scrub:
+            renderer.scrub()
+        for i in (renderer.n_frames - 1, 0):
+            renderer.show_frame(i)
+            blitted = np.array(canvas.buffer_rgba())
+            canvas.draw()
+            assert np.array_equal(blitted, np.array(canvas.buffer_rgba())), 'frame {} differs'.format(i)
+
+
+def bench_render(sizes=(2, 32), n_frames=40):
+    ''' Frames per second of a k trajectory: draw_network_state per frame against TrajectoryRenderer. '''
+    import os
+    import tempfile
+    from matplotlib import pyplot as plt
+    from render_utils import TrajectoryRenderer
+    rng = np.random.default_rng(0)
+    print('bench_render: {} frames of a random k walk, logical network'.format(n_frames))
+    print('{:>6} {:>12} {:>12} {:>12} {:>12}'.format('size', 'legacy', 'redraw', 'blit', 'gif'))
+    for size in sizes:
+        net = _network(size, rng)
+        ks = np.clip(net.get_ks() + np.cumsum(rng.integers(-3, 4, size=(n_frames, len(net.get_ks()))), axis=0),
+                     -127, 127)
+        nodeweights = np.zeros(len(net.topology.node_names))
+
+        def legacy():
+            for k in ks:
+                net.load_state(dict(zip(net.edge.name, k)))
+                fig, ax = net.draw_network_state(nodeweights=nodeweights)
+                fig.canvas.draw()
+                plt.close(fig)
+
+        renderer = TrajectoryRenderer(net, ks)
+        if size == sizes[0]:
+            _check_blitted_frames(renderer)
+
+        def redraw():
+            for i in range(n_frames):
+                renderer.update(i)
+                renderer.fig.canvas.draw()
+
+        def blit():
+            for i in range(n_frames):
+                renderer.show_frame(i)
+
+        def gif():
+            with tempfile.TemporaryDirectory() as tmp:
+                renderer.save(os.path.join(tmp, 'trajectory.gif'))
+
+        fps = [n_frames / _timeit(run, 1) for run in (legacy, redraw, blit, gif)]
+        plt.close(renderer.fig)
+        print('{:>6} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}'.format('{0}x{0}'.format(size), *fps))
+    print('(frames per second)')
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [n for n in dir() if n.startswith('bench_')]
+    for name in names:
+        globals()[name]()
+        print()
@@ -0,0 +1,224 @@
+''' Calibration of the circuit model against the node voltages measured during training.
+
+RKMNetwork.get_conductances assumes ideal digipots (RKMNetwork.ideal_resistances):
+a leg conducts with FULL_SCALE*(1-|k|/128) ohms when its polarity matches the
+sign of k and FULL_SCALE ohms otherwise (RKMNetwork.FULL_SCALE = 1e5).
+fit_calibration fits, to every row of one or more training
+trajectories at once, an affine correction of that resistance per full-graph
+edge,
+
+    R = FULL_SCALE * offset + scale * R_ideal,
+
+together with the analog front end: the clamp rails (the zero value at their
+mean, as in RKMNetwork.clamp) and a gain and offset between node voltages and
+the measured aV*/aH*/analogZero columns (the readConvert/nodeGain constants of
+ReadWrite._conversions). The measurements are modelled as in
+RKMNetwork.replay: aV from H clamped to DH, aH from V clamped to RV.
+
+The returned WiperCalibration plugs back into the network:
+
+    calibration = fit_calibration(net, [df0, df1])
+    net.resistance_model = calibration
+    net.clamp_solve(vals=[1, 0], analogRails=calibration.analogRails)
+'''
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+
+from Network import RKMNetwork
+
+
+class WiperCalibration(object):
+    ''' Calibrated resistance model of the legs of an RKM network and its analog front end.
+
+    Parameters
+    ----------
+    offset, scale : numpy.ndarray
+        Per full-graph edge: R = FULL_SCALE * offset + scale * R_ideal.
+    analogRails : tuple of float, optional
+        Low and high clamp voltages.
+    gain, voltage_offset : float, optional
+        Measured voltage = gain * node voltage + voltage_offset.
+    result : scipy.optimize.OptimizeResult, optional
+        Result of the fit that produced the calibration.
+    '''
+
+    def __init__(self, offset, scale, analogRails=(1.0, 3.0), gain=1., voltage_offset=0., result=None):
+        self.offset = np.asarray(offset, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.analogRails = [float(a) for a in analogRails]
+        self.gain = float(gain)
+        self.voltage_offset = float(voltage_offset)
+        self.result = result
+
+    @classmethod
+    def ideal(cls, network, analogRails=(1.0, 3.0)):
+        ''' The model RKMNetwork.get_conductances assumes, for every full-graph edge of network. '''
+        ne = network.circuit.ne
+        return cls(np.zeros(ne), np.ones(ne), analogRails)
+
+    def resistances(self, ideal):
+        ''' Calibrated resistances of the legs whose ideal resistances are ideal (..., n_full_edges). '''
+        return RKMNetwork.FULL_SCALE * self.offset + self.scale * ideal
+
+    def measured(self, V):
+        ''' Voltages the analog measurements report for node voltages V. '''
+        return self.gain * np.asarray(V) + self.voltage_offset
+
+    def _vector(self):
+        return np.concatenate([self.offset, self.scale, self.analogRails, [self.gain, self.voltage_offset]])
+
+
+def _clamp_design(network, FB, patterns):
+    ''' Clamped node indices and the weights of the two rails in the clamp values of every pattern. '''
+    indices, units, pm = network._clamp_nodes(FB)
+    vals = np.where(units >= 0, patterns[:, units], 1)
+    # a clamped 0 sits at the mean of the rails
+    zero = 0.5 * (vals == 0)
+    return indices, np.where(vals != 0, ~pm, 0) + zero, np.where(vals != 0, pm, 0) + zero
+
+
+class _CalibrationProblem(object):
+    ''' Residuals and analytic Jacobian of the calibration fit, batched over the rows. '''
+
+    def __init__(self, network, df, regularization):
+        self.network = network
+        self.circuit = network.circuit
+        self.regularization = regularization
+        self.x_ideal = WiperCalibration.ideal(network)._vector()
+        Vnames = ['V{}'.format(i) for i in range(network.NV)]
+        Hnames = ['H{}'.format(j) for j in range(network.NH)]
+        columns = (['D' + n for n in Hnames] + ['R' + n for n in Vnames]
+                   + ['a' + n for n in Vnames + Hnames] + ['analogZero'])
+        measured = df[columns].to_numpy(dtype=float)
+        ks = network.load_states(df)
+        # rows without measurements, or with a leg the ideal model shorts
+        valid = np.all(np.isfinite(measured), axis=1) & np.all(np.abs(ks) < 128, axis=1)
+        if not valid.any():
+            raise ValueError('no rows with measurements to calibrate against')
+        measured = measured[valid]
+        self.n_rows = len(measured)
+        self.ideal = network.ideal_resistances(ks[valid])
+        DH, RV, aV, aH, self.analogZero = np.split(
+            measured, np.cumsum([network.NH, network.NV, network.NV, network.NH]), axis=1)
+        self.analogZero = self.analogZero[:, 0]
+
+        topology = network.topology
+        self.groups = []
+        for FB, patterns, plus, y in ((1, DH, topology.plus_nodes('V'), aV),
+                                      (0, RV, topology.plus_nodes('H'), aH)):
+            clamped, Mminus, Mplus = _clamp_design(network, FB, patterns.astype(int))
+            free = np.setdiff1d(np.arange(self.circuit.n), clamped)
+            self.groups.append({'clamped': clamped, 'free': free, 'Mminus': Mminus, 'Mplus': Mplus,
+                                'measured': np.searchsorted(free, plus), 'y': y})
+        self._cache = (None, None, None)
+
+    def _evaluate(self, x):
+        if self._cache[0] is not None and np.array_equal(self._cache[0], x):
+            return self._cache[1:]
+        c = self.circuit
+        ne = c.ne
+        offset, scale = x[:ne], x[ne:2 * ne]
+        aMinus, aPlus, gain, voffset = x[2 * ne:]
+        R = self.network.FULL_SCALE * offset + scale * self.ideal
+        g = 1. / R
+        H = c.hessian_batch(g)
+        a, b = c.edges[:, 0], c.edges[:, 1]
+        # dg/d(offset) and dg/d(scale)
+        dg_offset = -g ** 2 * self.network.FULL_SCALE
+        dg_scale = -g ** 2 * self.ideal
+
+        residuals, jacobians = [], []
+        for group in self.groups:
+            free, clamped, meas = group['free'], group['clamped'], group['measured']
+            F = aMinus * group['Mminus'] + aPlus * group['Mplus']
+            H_ff = H[:, free[:, None], free]
+            H_fc = H[:, free[:, None], clamped]
+            # free voltages and the adjoints of the measured nodes from one batched solve
+            E = np.zeros((len(free), len(meas)))
+            E[meas, np.arange(len(meas))] = 1.
+            rhs = np.concatenate([-(H_fc @ F[:, :, None]), np.broadcast_to(E, (self.n_rows,) + E.shape)], axis=2)
+            X = np.linalg.solve(H_ff, rhs)
+            V = np.empty((self.n_rows, c.n))
+            V[:, clamped] = F
+            V[:, free] = X[:, :, 0]
+            Lambda = np.zeros((self.n_rows, c.n, len(meas)))
+            Lambda[:, free] = X[:, :, 1:]
+            Vm = V[:, free[meas]]
+            residuals.append((gain * Vm + voffset - group['y']).ravel())
+
+            # dVm/dg as in Circuit.sensitivity, dVm/dF from the adjoints
+            dVdg = -(Lambda[:, b] - Lambda[:, a]).transpose(0, 2, 1) * (V[:, b] - V[:, a])[:, None, :]
+            dVdF = -np.einsum('rfm,rfc->rmc', X[:, :, 1:], H_fc)
+            J = np.concatenate([
+                gain * dVdg * dg_offset[:, None, :],
+                gain * dVdg * dg_scale[:, None, :],
+                gain * np.einsum('rmc,rc->rm', dVdF, group['Mminus'])[:, :, None],
+                gain * np.einsum('rmc,rc->rm', dVdF, group['Mplus'])[:, :, None],
+                Vm[:, :, None],
+                np.ones(Vm.shape + (1,)),
+            ], axis=2)
+            jacobians.append(J.reshape(-1, len(x)))
+
+        # the measured reference voltage is the mean of the rails
+        aZero = 0.5 * (aMinus + aPlus)
+        residuals.append(gain * aZero + voffset - self.analogZero)
+        J0 = np.zeros((self.n_rows, len(x)))
+        J0[:, 2 * ne:] = [0.5 * gain, 0.5 * gain, aZero, 1.]
+        jacobians.append(J0)
+
+        # weak pull towards the ideal model: the overall conductance scale and
+        # the rails against gain and offset are not determined by the data
+        residuals.append(self.regularization * (x - self.x_ideal))
+        jacobians.append(self.regularization * np.eye(len(x)))
+        self._cache = (x.copy(), np.concatenate(residuals), np.concatenate(jacobians))
+        return self._cache[1:]
+
+    def residuals(self, x):
+        return self._evaluate(x)[0]
+
+    def jacobian(self, x):
+        return self._evaluate(x)[1]
+
+
+def fit_calibration(network, trajectories, initial=None, regularization=0.1, **kwargs):
+    ''' Fit a WiperCalibration to the measured node voltages of training trajectories.
+
+    All rows of all trajectories are fitted together by
+    scipy.optimize.least_squares, with batched solves of every row's circuit
+    and the analytic Jacobian of the measured voltages (adjoint method, as in
+    Circuit.sensitivity).
+
+    Parameters
+    ----------
+    network : RKMNetwork
+        Network of the trajectories.
+    trajectories : pandas.DataFrame or list of pandas.DataFrame
+        Training trajectories (e.g. read from trainXX.csv files), with the k
+        columns, DH*, RV*, aV*, aH* and analogZero.
+    initial : WiperCalibration, optional
+        Starting point. Default: the ideal model.
+    regularization : float, optional
+        Weight (in volts) of the pull of every parameter towards the ideal model.
+    **kwargs
+        Further arguments of scipy.optimize.least_squares. Defaults here:
+        x_scale='jac' and ftol=1e-5, the measured voltages being known to a
+        few mV.
+
+    Returns
+    -------
+    WiperCalibration
+        Fitted model; its result attribute holds the least_squares result.
+    '''
+    if not isinstance(trajectories, pd.DataFrame):
+        trajectories = pd.concat(list(trajectories), ignore_index=True)
+    problem = _CalibrationProblem(network, trajectories, regularization)
+    x0 = problem.x_ideal if initial is None else initial._vector()
+    ne = network.circuit.ne
+    kwargs.setdefault('x_scale', 'jac')
+    kwargs.setdefault('ftol', 1e-5)
+    lower = np.concatenate([np.zeros(ne), np.full(ne, 1e-2), np.full(4, -np.inf)])
+    result = least_squares(problem.residuals, x0, jac=problem.jacobian,
+                           bounds=(lower, np.inf), **kwargs)
+    x = result.x
+    return WiperCalibration(x[:ne], x[ne:2 * ne], x[2 * ne:2 * ne + 2], x[-2], x[-1], result=result)
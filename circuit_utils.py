@@ -3,8 +3,77 @@ from __future__ import annotations
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
-from scipy.sparse import bmat, csr_matrix
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import bmat, csc_array, csr_matrix, diags
+from scipy.sparse.linalg import cg, splu, spsolve
+
+
+class _ReducedInverse(object):
+    ''' Dense inverse of the free-node block of the hessian, for one set of clamped nodes.
+
+    Used as the 'dense' solver of Circuit. update() applies the conductance
+    change of a few edges as a Woodbury correction of the inverse, so a single
+    edge change costs O(n^2) instead of a refactorization.
+    '''
+
+    def __init__(self, circuit, clamped):
+        self.circuit = circuit
+        self.clamped = clamped
+        self.free = np.setdiff1d(np.arange(circuit.n), clamped)
+        # position of every node among the free (or clamped) nodes, -1 if it is not one
+        self.free_position = np.full(circuit.n, -1)
+        self.free_position[self.free] = np.arange(len(self.free))
+        self.clamped_position = np.full(circuit.n, -1)
+        self.clamped_position[clamped] = np.arange(len(clamped))
+        self.refactor()
+
+    def refactor(self):
+        H = self.circuit.hessian_batch(self.circuit.conductances)[0]
+        self.inverse = np.linalg.inv(H[np.ix_(self.free, self.free)])
+        self.H_fc = H[np.ix_(self.free, self.clamped)]
+        self.n_updates = 0
+        self._transfer = None
+
+    def update(self, edges, dg):
+        ''' Account for the conductances of edges changing by dg (the circuit already holds the new values). '''
+        self.n_updates += len(edges)
+        self._transfer = None
+        if self.n_updates >= self.circuit.REFACTOR_EVERY:
+            self.refactor()
+            return
+        ends = self.circuit.edges[edges]
+        free = self.free_position[ends]
+        # H_ff changes by U diag(dg) U^T, U holding the free part of the incidence columns
+        # and A^-1 U is gathered from the columns of the inverse
+        U = np.zeros((len(self.free), len(edges)))
+        AU = np.zeros_like(U)
+        for side, sign in ((0, -1.), (1, 1.)):
+            mask = free[:, side] >= 0
+            U[free[mask, side], np.flatnonzero(mask)] = sign
+            AU[:, mask] += sign * self.inverse[:, free[mask, side]]
+        # an edge between a free and a clamped node changes H_fc by -dg
+        for a, b in ((0, 1), (1, 0)):
+            mask = (free[:, a] >= 0) & (free[:, b] < 0)
+            np.add.at(self.H_fc, (free[mask, a], self.clamped_position[ends[mask, b]]), -dg[mask])
+        S = np.eye(len(edges)) + dg[:, None] * (U.T @ AU)
+        self.inverse -= AU @ np.linalg.solve(S, dg[:, None] * AU.T)
+
+    @property
+    def transfer(self):
+        ''' Free voltages per unit clamped voltage, -H_ff^-1 H_fc. '''
+        if self._transfer is None:
+            self._transfer = -(self.inverse @ self.H_fc)
+        return self._transfer
+
+    def __call__(self, F):
+        V = np.empty((self.circuit.n, F.shape[1]))
+        V[self.clamped] = F
+        V[self.free] = self.transfer @ F
+        return V
+
+    def adjoint(self, W):
+        Lambda = np.zeros((self.circuit.n, W.shape[1]))
+        Lambda[self.free] = self.inverse @ W[self.free]
+        return Lambda
 
 
 class Circuit(object):
@@ -27,8 +96,19 @@ class Circuit(object):
         Number of edges in the graph.
     pts : numpy.ndarray
         Positions of the nodes in the graph.
+    edges : numpy.ndarray
+        (ne, 2) node indices of the two ends of every edge.
     '''
 
+    # circuits with at most this many nodes are solved with dense numpy linear
+    # algebra by method='auto', larger ones with the sparse reduced system
+    # (bench_dense_threshold: dense faster up to 260 nodes, 64x64, about even
+    # at 388, 96x96, and slower at 516, 128x128)
+    DENSE_MAX_NODES = 320
+    # dense factorizations updated by update_conductances are recomputed from
+    # scratch after this many edge changes, to bound the rounding drift
+    REFACTOR_EVERY = 256
+
     def __init__(self, graph):
         if isinstance(graph, str):
             self.graph = nx.read_gpickle(graph)
@@ -40,6 +120,38 @@ class Circuit(object):
         self.pts = np.array(
             [self.graph.nodes[node]['pos'] for node in graph.nodes])
         self.incidence_matrix = nx.incidence_matrix(self.graph, oriented=True)
+        index = {node: i for i, node in enumerate(self.graph.nodes)}
+        self.edges = np.array([(index[u], index[v]) for u, v in self.graph.edges], dtype=int).reshape(-1, 2)
+        self._factors = {}
+
+    @classmethod
+    def from_edges(cls, edges, pts):
+        ''' Circuit of an edge list of node indices, without a networkx graph.
+
+        Parameters
+        ----------
+        edges : array_like
+            (ne, 2) array with the two end nodes of every edge. The incidence
+            matrix has -1 at the first and +1 at the second, as networkx.
+        pts : array_like
+            (n, 2) positions of the nodes.
+
+        Returns
+        -------
+        Circuit
+            Circuit with graph set to None.
+        '''
+        self = cls.__new__(cls)
+        self.graph = None
+        self.pts = np.asarray(pts, dtype=float)
+        self.edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        self.n = len(self.pts)
+        self.ne = len(self.edges)
+        self.incidence_matrix = csc_array(
+            (np.tile([-1., 1.], self.ne), (self.edges.ravel(), np.repeat(np.arange(self.ne), 2))),
+            shape=(self.n, self.ne))
+        self._factors = {}
+        return self
 
     def setConductances(self, conductances):
         ''' Set the conductances of the edges in the graph.
@@ -55,6 +167,41 @@ class Circuit(object):
         if isinstance(conductances, list):
             conductances = np.array(conductances)
         self.conductances = conductances
+        self._factors = {}
+
+    def update_conductances(self, edges, conductances):
+        ''' Change the conductances of a few edges, keeping the dense factorizations.
+
+        Cached 'dense' factorizations (the default of small circuits) are
+        updated with a low-rank Woodbury correction, O(n^2) per changed edge,
+        and refactorized every REFACTOR_EVERY edge changes. The other cached
+        factorizations are dropped, as by setConductances.
+
+        Parameters
+        ----------
+        edges : array_like of int
+            Indices of the edges to change, without repetitions.
+        conductances : array_like of float
+            New conductances of those edges.
+        '''
+        try:
+            self.conductances
+        except AttributeError:
+            raise AttributeError('Conductances have not been set yet.')
+        edges = np.atleast_1d(np.asarray(edges, dtype=int))
+        conductances = np.broadcast_to(np.asarray(conductances, dtype=float), edges.shape)
+        dg = conductances - self.conductances[edges]
+        changed = dg != 0
+        edges, dg = edges[changed], dg[changed]
+        if not len(edges):
+            return
+        # a copy, the array given to setConductances is not modified
+        self.conductances = np.array(self.conductances, dtype=float)
+        self.conductances[edges] = conductances[changed]
+        self._factors = {key: solver for key, solver in self._factors.items()
+                         if isinstance(solver, _ReducedInverse)}
+        for solver in self._factors.values():
+            solver.update(edges, dg)
 
     def _hessian(self):
         ''' Compute the Hessian of the network with respect to the conductances.
@@ -111,7 +258,144 @@ class Circuit(object):
                                      dtype=float)
         return sparseExtendedHessian
 
-    def solve(self, Q, f):
+    def _clamped_indices(self, Q):
+        ''' Recover the indices of the constrained nodes from the constraint matrix Q.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q
+
+        Returns
+        -------
+        numpy.ndarray
+            Indices of the constrained nodes, ordered like the columns of Q.
+        '''
+        if Q.format == 'csr':
+            # one entry per column: avoids the COO conversion on every solve
+            rows = np.repeat(np.arange(Q.shape[0]), np.diff(Q.indptr))
+            return rows[np.argsort(Q.indices)]
+        Q = Q.tocoo()
+        return Q.row[np.argsort(Q.col)]
+
+    def _reduced_hessian(self, Q):
+        ''' Split the hessian into the blocks acting on the free and the constrained nodes.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q
+
+        Returns
+        -------
+        free : numpy.ndarray
+            Indices of the free nodes.
+        clamped : numpy.ndarray
+            Indices of the constrained nodes, ordered like the columns of Q.
+        H_ff : scipy.sparse.csc_matrix
+            Free-free block of the hessian. It is symmetric positive definite
+            as long as every free node is connected to a constrained node.
+        H_fc : scipy.sparse.csr_matrix
+            Free-constrained block of the hessian.
+        '''
+        clamped = self._clamped_indices(Q)
+        free = np.setdiff1d(np.arange(self.n), clamped)
+        H = self._hessian().tocsr()
+        H_f = H[free]
+        return free, clamped, H_f[:, free].tocsc(), H_f[:, clamped]
+
+    def _factorize(self, Q, method='saddle'):
+        ''' Factorize the circuit for the constraint matrix Q.
+
+        The factorization is cached until the conductances are changed, so that
+        repeated solves with the same clamped nodes only pay for the triangular solves.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q
+        method : str, optional
+            'saddle' factorizes the extended Hessian with a sparse LU.
+            'reduced' moves the constrained voltages to the right-hand side
+            (Schur complement) and factorizes the symmetric positive definite
+            free-node block with a symmetric ordering.
+            'cg' solves the same free-node block with Jacobi-preconditioned
+            conjugate gradients.
+            'dense' solves the free-node block with dense numpy linear
+            algebra, for small circuits.
+            'auto' is 'dense' up to DENSE_MAX_NODES nodes and 'reduced' above.
+
+        Returns
+        -------
+        callable
+            Function mapping source vectors F of size len(indices_nodes) x m
+            to voltages V of size n x m. Its adjoint attribute maps node
+            weights W of size n x m to the solutions of the free-node system
+            H_ff x = W_f, zero on the constrained nodes (see sensitivity).
+        '''
+        method = self._method(method)
+        key = (method, self._clamped_indices(Q).tobytes())
+        if key in self._factors:
+            return self._factors[key]
+        if method == 'saddle':
+            lu = splu(self._extended_hessian(Q).tocsc())
+
+            def solver(F):
+                F_extended = np.vstack([np.zeros((self.n, F.shape[1])), F])
+                return lu.solve(F_extended)[:self.n]
+
+            def adjoint(W):
+                # the multipliers take up the clamped rows, the solution vanishes there
+                W_extended = np.vstack([W, np.zeros((Q.shape[1], W.shape[1]))])
+                return lu.solve(W_extended)[:self.n]
+        elif method in ('reduced', 'cg'):
+            free, clamped, H_ff, H_fc = self._reduced_hessian(Q)
+            if method == 'reduced':
+                lu = splu(H_ff,
+                          permc_spec='MMD_AT_PLUS_A',
+                          diag_pivot_thresh=0.,
+                          options=dict(SymmetricMode=True))
+                solve_free = lu.solve
+            else:
+                M = diags(1. / H_ff.diagonal())
+
+                def solve_free(b):
+                    x = np.empty_like(b)
+                    for j in range(b.shape[1]):
+                        x[:, j], info = cg(H_ff, b[:, j], rtol=1e-12, M=M)
+                        if info != 0:
+                            raise RuntimeError(
+                                'Conjugate gradients did not converge.')
+                    return x
+
+            def solver(F):
+                V = np.empty((self.n, F.shape[1]))
+                V[clamped] = F
+                V[free] = solve_free(-(H_fc @ F))
+                return V
+
+            def adjoint(W):
+                Lambda = np.zeros((self.n, W.shape[1]))
+                Lambda[free] = solve_free(np.ascontiguousarray(W[free]))
+                return Lambda
+        elif method == 'dense':
+            # the free voltages are a fixed linear map of the clamped ones
+            solver = _ReducedInverse(self, self._clamped_indices(Q))
+        else:
+            raise ValueError(
+                "method must be 'auto', 'saddle', 'reduced', 'cg' or 'dense', not {!r}.".format(
+                    method))
+        if method != 'dense':
+            solver.adjoint = adjoint
+        self._factors[key] = solver
+        return solver
+
+    def _method(self, method):
+        if method == 'auto':
+            return 'dense' if self.n <= self.DENSE_MAX_NODES else 'reduced'
+        return method
+
+    def solve(self, Q, f, method='auto'):
         ''' Solve the circuit with the constraint matrix Q and the source vector f.
 
         Parameters
@@ -120,6 +404,10 @@ class Circuit(object):
             Constraint matrix Q
         f : numpy.ndarray
             Source vector f. f has size len(indices_nodes).
+        method : str, optional
+            'saddle' solves the extended saddle-point system, 'reduced',
+            'cg' and 'dense' solve the reduced free-node system; 'auto'
+            (default) picks 'dense' or 'reduced' by size. See _factorize.
 
         Returns
         -------
@@ -132,11 +420,187 @@ class Circuit(object):
             raise AttributeError('Conductances have not been set yet.')
         if len(f) != Q.shape[1]:
             raise ValueError('Source vector f has the wrong size.')
+        method = self._method(method)
+        if method != 'saddle':
+            f = np.asarray(f, dtype=float)
+            return self._factorize(Q, method)(f[:, None])[:, 0]
         H = self._extended_hessian(Q)
         f_extended = np.hstack([np.zeros(self.n), f])
         V = spsolve(H, f_extended)[:self.n]
         return V
 
+    def solve_many(self, Q, F, method='auto'):
+        ''' Solve the circuit with the constraint matrix Q for a stack of source vectors.
+
+        The circuit is factorized once and the factorization is reused for every source vector.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q
+        F : numpy.ndarray
+            Source vectors. F has size n_patterns x len(indices_nodes).
+        method : str, optional
+            'auto', 'saddle', 'reduced', 'cg' or 'dense'. See _factorize.
+
+        Returns
+        -------
+        numpy.ndarray
+            Solution matrix V. V has size n_patterns x n.
+        '''
+        try:
+            self.conductances
+        except AttributeError:
+            raise AttributeError('Conductances have not been set yet.')
+        F = np.atleast_2d(F)
+        if F.shape[1] != Q.shape[1]:
+            raise ValueError('Source vectors F have the wrong size.')
+        solver = self._factorize(Q, method)
+        return solver(np.ascontiguousarray(F.T, dtype=float)).T
+
+    def sensitivity(self, Q, f, weights=None, method='auto'):
+        ''' Derivatives of the node voltages with respect to the edge conductances.
+
+        With the voltages V of the clamped circuit, dV/dg_e = -H_ff^-1 b_e (b_e.V)
+        where b_e is the incidence column of edge e. The derivatives of a
+        weighted sum of voltages w.V (e.g. the gradient of a loss, w = dL/dV)
+        need a single adjoint solve H_ff x = w_f with the cached factorization;
+        the full Jacobian needs one per free node.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q
+        f : numpy.ndarray
+            Source vector f. f has size len(indices_nodes).
+        weights : numpy.ndarray, optional
+            Node weights of size n, or m x n for m weighted sums. Default: the
+            full Jacobian of the node voltages.
+        method : str, optional
+            'auto', 'saddle', 'reduced', 'cg' or 'dense'. See _factorize.
+
+        Returns
+        -------
+        numpy.ndarray
+            Jacobian dV/dg of size n x ne (zero on the constrained nodes), or
+            the gradients of the weighted sums, of size ne or m x ne.
+        '''
+        try:
+            self.conductances
+        except AttributeError:
+            raise AttributeError('Conductances have not been set yet.')
+        if len(f) != Q.shape[1]:
+            raise ValueError('Source vector f has the wrong size.')
+        solver = self._factorize(Q, method)
+        V = solver(np.asarray(f, dtype=float)[:, None])[:, 0]
+        a, b = self.edges[:, 0], self.edges[:, 1]
+        W = np.eye(self.n) if weights is None else np.atleast_2d(np.asarray(weights, dtype=float)).T
+        Lambda = solver.adjoint(W)
+        gradient = -(Lambda[b] - Lambda[a]).T * (V[b] - V[a])
+        if weights is not None and np.ndim(weights) == 1:
+            return gradient[0]
+        return gradient
+
+    def _hessian_index(self):
+        # flat n x n positions of the four hessian entries of every edge
+        if getattr(self, '_hessian_flat', None) is None:
+            u, v = self.edges[:, 0], self.edges[:, 1]
+            self._hessian_flat = np.concatenate([u * self.n + u, v * self.n + v,
+                                                 u * self.n + v, v * self.n + u])
+        return self._hessian_flat
+
+    def hessian_batch(self, conductances):
+        ''' Dense hessians for a batch of conductance vectors, assembled directly from the edge list.
+
+        Parameters
+        ----------
+        conductances : numpy.ndarray
+            Conductances of the edges. conductances has size batch x ne.
+
+        Returns
+        -------
+        numpy.ndarray
+            Hessians. The array has size batch x n x n.
+        '''
+        conductances = np.atleast_2d(np.asarray(conductances, dtype=float))
+        batch = len(conductances)
+        flat = self._hessian_index() + (self.n * self.n) * np.arange(batch)[:, None]
+        weights = np.concatenate([conductances, conductances, -conductances, -conductances], axis=1)
+        H = np.bincount(flat.ravel(), weights=weights.ravel(), minlength=batch * self.n * self.n)
+        return H.reshape(batch, self.n, self.n)
+
+    def transfer_batch(self, Q, conductances):
+        ''' Linear maps from clamped to node voltages for a batch of conductance vectors.
+
+        The voltages of a circuit with sources f are V = T.dot(f), so one
+        transfer matrix per conductance vector serves any number of source vectors.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q, shared by the whole batch.
+        conductances : numpy.ndarray
+            Conductances of the edges. conductances has size batch x ne.
+
+        Returns
+        -------
+        numpy.ndarray
+            Transfer matrices T. The array has size batch x n x len(indices_nodes).
+        '''
+        conductances = np.atleast_2d(conductances)
+        if conductances.shape[1] != self.ne:
+            raise ValueError(
+                'conductances must have the same length as the number of edges')
+        clamped = self._clamped_indices(Q)
+        free = np.setdiff1d(np.arange(self.n), clamped)
+        H = self.hessian_batch(conductances)
+        T = np.zeros((len(conductances), self.n, len(clamped)))
+        T[:, clamped, np.arange(len(clamped))] = 1.
+        T[:, free] = -np.linalg.solve(H[:, free[:, None], free], H[:, free[:, None], clamped])
+        return T
+
+    def solve_batch(self, Q, F, conductances):
+        ''' Solve the circuit for a batch of conductance vectors and source vectors.
+
+        Each circuit is solved on its dense reduced free-node system, so this is
+        meant for small circuits whose conductances change from one solve to the next
+        (e.g. an ensemble of trainings). The conductances set with setConductances
+        are not used.
+
+        Parameters
+        ----------
+        Q : scipy.sparse.csr_matrix
+            Constraint matrix Q, shared by the whole batch.
+        F : numpy.ndarray
+            Source vectors. F has size batch x len(indices_nodes), or
+            len(indices_nodes) to use the same source vector for the whole batch.
+        conductances : numpy.ndarray
+            Conductances of the edges. conductances has size batch x ne, or ne
+            to use the same conductances for the whole batch.
+
+        Returns
+        -------
+        numpy.ndarray
+            Solution matrix V. V has size batch x n.
+        '''
+        F = np.atleast_2d(F)
+        conductances = np.atleast_2d(conductances)
+        if F.shape[1] != Q.shape[1]:
+            raise ValueError('Source vectors F have the wrong size.')
+        if conductances.shape[1] != self.ne:
+            raise ValueError(
+                'conductances must have the same length as the number of edges')
+        clamped = self._clamped_indices(Q)
+        free = np.setdiff1d(np.arange(self.n), clamped)
+        H = self.hessian_batch(conductances)
+        H_ff = H[:, free[:, None], free]
+        H_fc = H[:, free[:, None], clamped]
+        batch = max(len(F), len(conductances))
+        V = np.empty((batch, self.n))
+        V[:, clamped] = F
+        V[:, free] = np.linalg.solve(H_ff, -(H_fc @ F[:, :, None]))[:, :, 0]
+        return V
+
     def plot_node_state(self,
                         node_state,
                         title=None,
@@ -197,12 +661,7 @@ class Circuit(object):
             Colormap to use for the plot.
         '''
         _cmap = plt.cm.get_cmap(cmap)
-        pos_edges = np.array([
-            np.array([
-                self.graph.nodes[edge[0]]['pos'],
-                self.graph.nodes[edge[1]]['pos']
-            ]).T for edge in self.graph.edges()
-        ])
+        pos_edges = self.pts[self.edges].transpose(0, 2, 1)
         norm = plt.Normalize(vmin=np.min(edge_state), vmax=np.max(edge_state))
         fig, axs = plt.subplots(1, 1, figsize=(4, 4))
         for i in range(len(pos_edges)):
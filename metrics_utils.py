@@ -0,0 +1,109 @@
+''' Reconstruction metrics of training trajectories, batched over epochs and trials.
+
+All functions take the stacked reconstruction arrays of any number of rows:
+Vtest and Vrecon of shape (..., numtest, NV), e.g. (n_rows, numtest, NV) for
+one trajectory from storage_utils.load_arrays or (n_trials, n_rows, numtest, NV)
+from TrainingEnsemble.column, and reduce the last two axes.
+'''
+import numpy as np
+from scipy.interpolate import make_smoothing_spline
+
+
+def _difference(Vtest, Vrecon):
+    Vtest = np.asarray(Vtest)
+    Vrecon = np.asarray(Vrecon)
+    # int8 states are compared in float32, measured voltages keep their precision
+    return np.subtract(Vtest, Vrecon, dtype=np.result_type(Vtest, Vrecon, np.float32))
+
+
+def mse(Vtest, Vrecon):
+    ''' Reconstruction error: mean over test patterns of the distance between test and reconstruction.
+
+    Same as np.mean(np.linalg.norm(Vtest.T - Vrecon.T, axis=0)) of the
+    plotting notebooks, for every row at once.
+
+    Parameters
+    ----------
+    Vtest, Vrecon : array_like
+        Arrays of shape (..., numtest, NV).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (...).
+    '''
+    diff = _difference(Vtest, Vrecon)
+    # sums over the short trailing axes as matrix-vector products, much faster
+    # than ufunc reductions over axes of a few elements
+    numtest, NV = diff.shape[-2:]
+    distance = np.sqrt(np.square(diff) @ np.ones(NV, dtype=diff.dtype))
+    return distance @ np.full(numtest, 1. / numtest, dtype=diff.dtype)
+
+
+def bit_error_rate(Vtest, Vrecon):
+    ''' Fraction of test patterns in which each visible unit is reconstructed wrong.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (..., NV).
+    '''
+    wrong = np.not_equal(Vtest, Vrecon)
+    numtest = wrong.shape[-2]
+    return np.matmul(np.full(numtest, 1. / numtest, dtype=np.float32), wrong, dtype=np.float32)
+
+
+def det_gap(Vtest, Vrecon, Vtest_det, Vrecon_det):
+    ''' Reconstruction error of the stochastic comparators minus that of the deterministic ones. '''
+    return mse(Vtest, Vrecon) - mse(Vtest_det, Vrecon_det)
+
+
+def smooth(steps, curves, lam=None):
+    ''' Smoothing-spline fit of many learning curves sampled at the same steps.
+
+    The fit is linear in the data, so all curves are fitted in one call of
+    scipy.interpolate.make_smoothing_spline. With lam=None one penalty is
+    chosen by generalized cross-validation for all curves together.
+
+    Parameters
+    ----------
+    steps : array_like
+        Increasing steps (e.g. epochs) of shape (n_steps,).
+    curves : array_like
+        Curves of shape (..., n_steps).
+    lam : float, optional
+        Smoothing penalty, as in make_smoothing_spline.
+
+    Returns
+    -------
+    numpy.ndarray
+        Smoothed curves evaluated at steps, same shape as curves.
+    '''
+    curves = np.asarray(curves, dtype=np.float64)
+    flat = curves.reshape(-1, curves.shape[-1]).T
+    spline = make_smoothing_spline(np.asarray(steps, dtype=np.float64), flat, lam=lam)
+    return spline(steps).T.reshape(curves.shape)
+
+
+def trajectory_metrics(columns):
+    ''' All metrics available from a dict of stacked columns.
+
+    Parameters
+    ----------
+    columns : dict
+        Vtest/Vrecon arrays and optionally Vtest_det/Vrecon_det, e.g. from
+        storage_utils.load_arrays.
+
+    Returns
+    -------
+    dict
+        MSE and BER, plus MSE_det, BER_det and det_gap when the deterministic
+        reconstructions are present.
+    '''
+    metrics = {'MSE': mse(columns['Vtest'], columns['Vrecon']),
+               'BER': bit_error_rate(columns['Vtest'], columns['Vrecon'])}
+    if 'Vtest_det' in columns and 'Vrecon_det' in columns:
+        metrics['MSE_det'] = mse(columns['Vtest_det'], columns['Vrecon_det'])
+        metrics['BER_det'] = bit_error_rate(columns['Vtest_det'], columns['Vrecon_det'])
+        metrics['det_gap'] = metrics['MSE'] - metrics['MSE_det']
+    return metrics
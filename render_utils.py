@@ -0,0 +1,200 @@
+''' Animated drawings of training trajectories on the network layout.
+
+RKMNetwork.draw_network_state and draw_fullnetwork_state build a new figure
+for every state. TrajectoryRenderer draws the network once, as in those
+methods, and every frame only changes the colors and widths of the existing
+edge (LineCollection) and node (PathCollection) artists:
+
+    renderer = TrajectoryRenderer(net, net.load_states(df))
+    renderer.scrub()                  # slider over the epochs, blitted
+    renderer.save('train00.gif')      # one frame per row of df
+'''
+import matplotlib.animation as animation
+import numpy as np
+from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
+from matplotlib.widgets import Slider
+
+NODE_COLOR = '#1f78b4'  # networkx default node color
+
+
+class TrajectoryRenderer(object):
+    ''' Frames of a training trajectory drawn with artists built once.
+
+    Parameters
+    ----------
+    network : RKMNetwork
+        Network whose layout (pos or fullpos) is drawn.
+    ks : array_like
+        k values of every frame, (n_frames, n_edges) in edge order, e.g.
+        RKMNetwork.load_states(df).
+    nodeweights : array_like, optional
+        Node colors of every frame, (n_frames, n_nodes) in the order of the
+        drawn graph (node_names, or full_node_names with full=True).
+    full : bool, optional
+        Draw the full circuit with edges colored by conductance, as
+        draw_fullnetwork_state, instead of the logical network colored by k.
+    erange, nrange : tuple of float, optional
+        Edge and node color ranges. Defaults as in draw_network_state /
+        draw_fullnetwork_state; nrange defaults to the range of nodeweights.
+    e_cmap, n_cmap : str, optional
+        Edge and node colormaps.
+    node_size : float, optional
+        Marker area of the nodes, as in networkx.draw_networkx.
+    ax : matplotlib.axes.Axes, optional
+        Axes to draw in. Default: a new figure.
+
+    Attributes
+    ----------
+    fig, ax : matplotlib figure and axes
+    edges : matplotlib.collections.LineCollection
+    nodes : matplotlib.collections.PathCollection
+    labels : list of matplotlib.text.Text
+        Node names, drawn over the nodes.
+    n_frames : int
+    '''
+
+    def __init__(self, network, ks, nodeweights=None, full=False, erange=None, nrange=None,
+                 e_cmap=None, n_cmap='RdYlBu', node_size=800, ax=None):
+        topology = network.topology
+        ks = np.atleast_2d(ks)
+        self.n_frames = len(ks)
+        if full:
+            pos = topology.full_positions()
+            ends = np.stack([topology.full_a, topology.full_b], axis=1)
+            names = topology.full_node_names
+            self._edge_values = network.get_conductances(ks)
+            self._edge_widths = None
+            erange = [1e-5, .00128] if erange is None else erange
+            e_cmap = 'jet' if e_cmap is None else e_cmap
+            label = r'Edge conductances [1/$\Omega$]'
+        else:
+            pos = topology.positions()
+            ends = np.stack([topology.edge_a, topology.edge_b], axis=1)
+            names = topology.node_names
+            self._edge_values = ks.astype(float)
+            self._edge_widths = np.abs(ks) / 128 * 60
+            erange = [-128, 128] if erange is None else erange
+            e_cmap = 'bwr' if e_cmap is None else e_cmap
+            label = 'Edge k'
+        self._node_values = None if nodeweights is None else np.atleast_2d(nodeweights)
+        if self._node_values is not None and nrange is None:
+            nrange = [np.min(self._node_values), np.max(self._node_values)]
+
+        if ax is None:
+            self.fig, self.ax = plt.subplots()
+        else:
+            self.fig, self.ax = ax.figure, ax
+        self.edges = LineCollection(pos[ends], cmap=plt.get_cmap(e_cmap), norm=Normalize(*erange),
+                                    linewidths=2., zorder=1)
+        self.ax.add_collection(self.edges)
+        if self._node_values is None:
+            self.nodes = self.ax.scatter(pos[:, 0], pos[:, 1], s=node_size, c=NODE_COLOR,
+                                         edgecolors='k', zorder=2)
+        else:
+            self.nodes = self.ax.scatter(pos[:, 0], pos[:, 1], s=node_size, c=self._node_values[0],
+                                         cmap=plt.get_cmap(n_cmap), norm=Normalize(*nrange),
+                                         edgecolors='k', zorder=2)
+        self.labels = [self.ax.text(x, y, name, ha='center', va='center', fontsize=12, zorder=3)
+                       for name, (x, y) in zip(names, pos)]
+        self.ax.autoscale_view()
+        self.ax.margins(0.08)
+        self.ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
+        self.fig.colorbar(plt.cm.ScalarMappable(norm=self.edges.norm, cmap=self.edges.cmap),
+                          ticks=np.linspace(erange[0], erange[1], 7), ax=self.ax,
+                          location='right', label=label)
+        self.update(0)
+        self._background = None
+        self._slider = None
+        # further artists redrawn with every blitted frame, because they sit
+        # above the edges and nodes: the axes frame, the node labels and the slider
+        self._blitted = list(self.ax.spines.values()) + self.labels
+
+    @property
+    def artists(self):
+        ''' Artists changed by update, for blitting. '''
+        return [self.edges, self.nodes]
+
+    def update(self, i):
+        ''' Set the colors and widths of frame i; returns the changed artists. '''
+        self.edges.set_array(self._edge_values[i])
+        if self._edge_widths is not None:
+            self.edges.set_linewidths(self._edge_widths[i])
+        if self._node_values is not None:
+            self.nodes.set_array(self._node_values[i])
+        return self.artists
+
+    def _animate(self, i):
+        # with blit=True FuncAnimation marks the returned artists animated and
+        # redraws only those, so the artists above the edges and nodes go with them
+        return self.update(i) + self._blitted
+
+    def animation(self, interval=50, blit=False, **kwargs):
+        ''' matplotlib FuncAnimation over all frames (keep a reference while it plays).
+
+        Frames are full redraws by default. FuncAnimation blits only the axes
+        bbox, which leaves out the outer half of the axes frame, so with
+        blit=True the frame is slightly off; show_frame and scrub blit the
+        whole figure instead.
+        '''
+        return animation.FuncAnimation(self.fig, self._animate, frames=self.n_frames,
+                                       interval=interval, blit=blit, **kwargs)
+
+    def save(self, path, fps=20, dpi=100, frames=None, writer=None):
+        ''' Encode frames to a video or GIF file, one frame at a time.
+
+        Frames are grabbed and handed to the writer as they are drawn: ffmpeg
+        (the default writer, e.g. for .mp4) encodes them as a stream, while
+        the Pillow writer (the default for .gif) keeps them until the end.
+        frames defaults to every frame.
+        '''
+        if writer is None:
+            if str(path).lower().endswith('.gif'):
+                writer = animation.PillowWriter(fps=fps)
+            else:
+                writer = animation.FFMpegWriter(fps=fps)
+        frames = range(self.n_frames) if frames is None else frames
+        with writer.saving(self.fig, path, dpi):
+            for i in frames:
+                self.update(i)
+                writer.grab_frame()
+
+    def _capture_background(self):
+        # the figure without the changing artists, restored before each blitted frame
+        artists = self.artists + self._blitted
+        for artist in artists:
+            artist.set_visible(False)
+        self.fig.canvas.draw()
+        self._background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in artists:
+            artist.set_visible(True)
+
+    def _draw_artists(self):
+        # in the order of a full draw
+        for artist in sorted(self.artists + self._blitted, key=lambda artist: artist.get_zorder()):
+            self.fig.draw_artist(artist)
+        self.fig.canvas.blit(self.fig.bbox)
+
+    def show_frame(self, i):
+        ''' Draw frame i by blitting only the changed artists onto the cached background. '''
+        if self._background is None:
+            self._capture_background()
+        self.update(i)
+        self.fig.canvas.restore_region(self._background)
+        self._draw_artists()
+
+    def scrub(self):
+        ''' Add a slider over the frames; moving it redraws by blitting. Returns the Slider. '''
+        if self._slider is None:
+            self.fig.subplots_adjust(bottom=0.15)
+            slider_ax = self.fig.add_axes([0.15, 0.03, 0.6, 0.04])
+            self._slider = Slider(slider_ax, 'frame', 0, self.n_frames - 1, valinit=0, valstep=1)
+            # the slider is blitted with the frame instead of redrawing the whole figure
+            self._slider.drawon = False
+            self._blitted.append(slider_ax)
+            self._background = None
+            self._slider.on_changed(lambda value: self.show_frame(int(value)))
+            # the background is out of date after a resize or a full redraw
+            self.fig.canvas.mpl_connect('resize_event', lambda event: setattr(self, '_background', None))
+        return self._slider
@@ -0,0 +1,339 @@
+''' Serial protocol helpers and a fake serial port for testing without hardware.
+
+The format_* functions reproduce the lines the supervisor firmware sends
+(sendMessageToPython, sendMessageWithVarToPython, send1DArrayToPython), and
+FakeSerial is an in-memory stand-in for serial.Serial that ReadWrite can read
+from and write to.
+
+After a 'binmode;1;' command the firmware sends the arrays named in
+FRAME_NAMES as binary frames (send1DArrayBinary) instead of ASCII lines:
+
+    0xA5 | type (0x01: int16) | name id | count (uint16) | count x int16 | checksum
+
+Multi-byte fields are little-endian and the checksum is the sum of the bytes
+from type to the end of the payload, modulo 256.
+'''
+import threading
+import time
+
+import numpy as np
+
+BUFFER = '        '
+DIVIDER = ':'
+
+FRAME_START = 0xA5
+FRAME_INT16 = 0x01
+FRAME_HEADER = 5
+# values in the longest frame a supervisor sends (ki, numE values); a longer
+# count in a header is taken as corruption by ReadWrite
+FRAME_MAX_COUNT = 1024
+# name ids of the binary frames, same order as binNames in RKM_supervisor_modular.ino
+FRAME_NAMES = ('ki', 'DA', 'DB', 'RA', 'RB', 'analogV', 'analogH',
+               'Vtest', 'Vrecon', 'clamped_vals')
+
+
+def format_msg(message, divider=DIVIDER):
+    ''' Line sent by sendMessageToPython. '''
+    return '{0}{1}msg{1}{2}{1}{0}\r\n'.format(BUFFER, divider, message).encode()
+
+
+def format_msgvar(name, var, divider=DIVIDER):
+    ''' Line sent by sendMessageWithVarToPython. '''
+    return '{0}{1}msgvar{1}{2}{1}{3}{1}{0}\r\n'.format(BUFFER, divider, name, var).encode()
+
+
+def format_1Darr(name, arr, divider=DIVIDER):
+    ''' Line sent by send1DArrayToPython. '''
+    payload = '[' + ', '.join(str(int(x)) for x in arr) + ']'
+    return '{0}{1}1Darr{1}{2}{1}{3}{1}{0}\r\n'.format(BUFFER, divider, name, payload).encode()
+
+
+def encode_frame(name, arr):
+    ''' Binary frame sent by send1DArrayBinary. '''
+    payload = np.asarray(arr, dtype='<i2').tobytes()
+    count = len(payload) // 2
+    body = bytes([FRAME_INT16, FRAME_NAMES.index(name), count & 0xFF, count >> 8]) + payload
+    return bytes([FRAME_START]) + body + bytes([sum(body) & 0xFF])
+
+
+def frame_size(header):
+    ''' Total length in bytes of the frame starting with header (at least FRAME_HEADER bytes). '''
+    return FRAME_HEADER + 2 * (header[3] | header[4] << 8) + 1
+
+
+def decode_frame(frame):
+    ''' Name and values of one binary frame.
+
+    Parameters
+    ----------
+    frame : bytes
+        One complete frame, start byte to checksum.
+
+    Returns
+    -------
+    name : str
+    values : numpy.ndarray
+        int16 values; a read-only view of frame, not a copy.
+
+    Raises
+    ------
+    ValueError
+        If frame is truncated, of an unknown type or name, or fails the checksum.
+    '''
+    if len(frame) < FRAME_HEADER + 1 or frame[0] != FRAME_START:
+        raise ValueError('not a frame')
+    if len(frame) != frame_size(frame):
+        raise ValueError('frame length does not match count')
+    if frame[1] != FRAME_INT16:
+        raise ValueError('unknown frame type {}'.format(frame[1]))
+    if frame[2] >= len(FRAME_NAMES):
+        raise ValueError('unknown name id {}'.format(frame[2]))
+    if sum(memoryview(frame)[1:-1]) & 0xFF != frame[-1]:
+        raise ValueError('checksum mismatch')
+    return FRAME_NAMES[frame[2]], np.frombuffer(frame, dtype='<i2', offset=FRAME_HEADER,
+                                                count=(len(frame) - FRAME_HEADER - 1) // 2)
+
+
+def _format_array(name, arr, binary):
+    if binary and name in FRAME_NAMES:
+        return encode_frame(name, arr)
+    return format_1Darr(name, arr)
+
+
+def _reconstruction_lines(Vtest, Vrecon, start, end, binary=False):
+    lines = [format_msg(start)]
+    for j, (vt, vr) in enumerate(zip(Vtest, Vrecon)):
+        lines.append(format_msgvar('testidx', j))
+        lines.append(_format_array('Vtest', vt, binary))
+        lines.append(_format_array('Vrecon', vr, binary))
+    lines.append(format_msg(end))
+    return lines
+
+
+def _step_lines(record, binary=False, first=False):
+    # messages of one D_state() and R_state() call of the firmware train() loop;
+    # usePrev is 0 only in the first R phase of a train command
+    D = [format_msg(m) for m in ('all triggers reset', 'FB = 0', 'useprev = 0',
+                                 'clamped data vals', 'readMem triggered',
+                                 'recordD triggered', 'all triggers reset')]
+    R = [format_msgvar('aRecord', record.get('aRecord', 1))]
+    for phase, usePrev, analog in (('f1', 0 if first else 1, None), ('b1', 1, 'analogV'), ('f1', 1, 'analogH')):
+        R.append(format_msg('all triggers reset'))
+        R.append(format_msgvar('usePrev', usePrev))
+        R.append(format_msg('readMem triggered'))
+        if analog is not None and analog in record:
+            R.append(format_msgvar('nmestimes', record['nmestimes']))
+            R.append(format_msgvar('analogZero', record['analogZero']))
+            R.append(_format_array(analog, record[analog], binary))
+        if phase == 'f1' and analog is not None:
+            R.append(format_msg('recordR triggered'))
+        R.append(format_msg('storeMem triggered'))
+        R.append(format_msg('all triggers reset'))
+    return D + R + [format_msg('update triggered')]
+
+
+def transcript_from_records(records, numtrain=2, binary=False):
+    ''' Serial transcript of a 'train' command that would produce records.
+
+    Parameters
+    ----------
+    records : list of dict
+        Records of one trial, as returned by ReadWrite.train_measure or
+        simulation_utils.simulate_training.
+    numtrain : int, optional
+        Number of training points per epoch (D and R phases per epoch).
+    binary : bool, optional
+        Send arrays as binary frames, as the firmware does after 'binmode;1;'.
+
+    Returns
+    -------
+    bytes
+        The lines the supervisor firmware sends, ending with 'finished'.
+    '''
+    lines = []
+    for i, record in enumerate(records):
+        if i > 0:
+            for j in range(numtrain):
+                lines += _step_lines(record, binary, first=(i == 1 and j == 0))
+            lines.append(format_msgvar('epoch', record['epoch']))
+            for name in ('ki', 'DA', 'DB', 'RA', 'RB'):
+                lines.append(_format_array(name, record[name], binary))
+        if 'Vtest_det' in record:
+            lines += _reconstruction_lines(record['Vtest_det'], record['Vrecon_det'],
+                                           'reconstruction_deterministic',
+                                           'finalizereconstructdet', binary)
+        lines += _reconstruction_lines(record['Vtest'], record['Vrecon'],
+                                       'reconstruction', 'finalizereconstruct', binary)
+        lines.append(format_msg('finalize'))
+    lines.append(format_msg('finished'))
+    return b''.join(lines)
+
+
+class FakeSerial(object):
+    ''' In-memory stand-in for serial.Serial.
+
+    Bytes fed with feed() (or given as transcript) are returned by read and
+    readline; bytes written by the host are collected in written and passed
+    to responder, whose return value is fed back. Reads honour timeout like
+    pyserial: None blocks, 0 returns immediately, otherwise waits up to timeout seconds.
+
+    Parameters
+    ----------
+    transcript : bytes, optional
+        Bytes available for reading from the start.
+    responder : callable, optional
+        Called with every chunk of bytes written by the host. It may return
+        bytes to feed back (e.g. a simulated device).
+    timeout : float, optional
+        Read timeout in seconds.
+    '''
+
+    def __init__(self, transcript=b'', responder=None, timeout=None):
+        self.timeout = timeout
+        self.responder = responder
+        self.written = bytearray()
+        self.is_open = True
+        self._buffer = bytearray(transcript)
+        self._cond = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        ''' Make data available for reading (the device side of the port). '''
+        with self._cond:
+            self._buffer += data
+            self._cond.notify_all()
+
+    def _wait_for(self, ready):
+        # waits in short slices so that exceptions injected into the reading
+        # thread (e.g. by func_timeout) are delivered
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while not ready():
+                if deadline is None:
+                    self._cond.wait(0.01)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._cond.wait(min(remaining, 0.01))
+
+    def read(self, size=1):
+        self._wait_for(lambda: len(self._buffer) >= size)
+        with self._cond:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def readline(self):
+        self._wait_for(lambda: b'\n' in self._buffer)
+        with self._cond:
+            end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+            data = bytes(self._buffer[:end])
+            del self._buffer[:end]
+        return data
+
+    def write(self, data):
+        self.written += data
+        if self.responder is not None:
+            reply = self.responder(bytes(data))
+            if reply:
+                self.feed(reply)
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._buffer.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeRKMDevice(object):
+    ''' Responder for FakeSerial that acknowledges supervisor config commands.
+
+    Commands are parsed from the ';'-separated stream written by the host, as
+    the firmware loop() does, and answered with the same messages ending in
+    'finished'. Given records, 'train;epochs;' is answered with the transcript
+    of the first epochs of them (see transcript_from_records), as ASCII lines
+    or, after 'binmode;1;', binary frames. Other commands are ignored.
+
+    Parameters
+    ----------
+    maxNode : int, optional
+        Number of clamp values read by the clamp command.
+    latency : float, optional
+        Seconds each command takes to run on the device.
+    records : list of dict, optional
+        Records of one trial played back by the train command, e.g. from
+        simulation_utils.simulate_training.
+    numtrain : int, optional
+        Number of training points per epoch in the played back transcript.
+    '''
+
+    # command: names under which its arguments are echoed back
+    CONFIG = {'alpha': ('alpha',), 'kwvar': ('kwvar',), 'kbvar': ('kbvar',),
+              'L2': ('L2',), 'L2max': ('L2max',), 'fb': ('FB',),
+              'useprev': ('useprev',), 'det': ('det',), 'detinf': ('detInf',),
+              'measureEvery': ('measureEvery',), 'resetval': ('resetval',),
+              'numprop': ('numProp',), 'binmode': ('binmode',),
+              'seed': ('board', 'seed')}
+    # command: message sent before 'finished'
+    ACTIONS = {'reset': 'reset', 'norm': 'normed'}
+
+    def __init__(self, maxNode=2, latency=0., records=None, numtrain=2):
+        self.maxNode = maxNode
+        self.latency = latency
+        self.records = records
+        self.numtrain = numtrain
+        self.state = {}
+        self._pending = ''
+
+    def _known(self, name):
+        return (name in self.CONFIG or name in self.ACTIONS or name == 'clamp'
+                or (name == 'train' and self.records is not None))
+
+    def _nargs(self, name):
+        if name == 'clamp':
+            return self.maxNode
+        if name == 'train':
+            return 1
+        return len(self.CONFIG.get(name, ()))
+
+    def _run(self, name, args):
+        time.sleep(self.latency)
+        if name in self.CONFIG:
+            lines = []
+            for key, arg in zip(self.CONFIG[name], args):
+                self.state[key] = int(arg)
+                lines.append(format_msgvar(key, int(arg)))
+        elif name == 'clamp':
+            lines = [format_1Darr('clamped_vals', [int(a) for a in args])]
+        elif name == 'train':
+            # the transcript ends with its own 'finished'
+            return transcript_from_records(self.records[:int(args[0]) + 1], self.numtrain,
+                                           binary=bool(self.state.get('binmode')))
+        else:
+            lines = [format_msg(self.ACTIONS[name])]
+        return b''.join(lines) + format_msg('finished')
+
+    def __call__(self, data):
+        self._pending += data.decode()
+        tokens = self._pending.split(';')
+        reply = b''
+        start = 0
+        while start < len(tokens) - 1:
+            name = tokens[start].strip()
+            if not self._known(name):
+                start += 1
+                continue
+            nargs = self._nargs(name)
+            if start + nargs >= len(tokens) - 1:
+                # arguments not written yet
+                break
+            reply += self._run(name, [t.strip() for t in tokens[start + 1:start + 1 + nargs]])
+            start += 1 + nargs
+        self._pending = ';'.join(tokens[start:])
+        return reply
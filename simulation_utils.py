@@ -0,0 +1,423 @@
+''' Software model of the RKM hardware training loop.
+
+The functions here mirror the supervisor firmware (RKM_supervisor_modular.ino)
+and the edge firmware (teensy_edge_modular.ino): the circuit is solved with
+Circuit, comparators digitize the node voltages against the reference voltage,
+and the wipers k are updated with the contrastive rule of the edge boards.
+'''
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy.special import expit
+
+READ_CONVERT = 3.3 / 4095.  # ADC counts to volts, as in ReadWrite._conversions['readConvert']
+
+
+def digitize(V, threshold, beta=None, rng=None):
+    ''' Comparator digitizing node voltages against a threshold.
+
+    Parameters
+    ----------
+    V : numpy.ndarray
+        Node voltages.
+    threshold : float
+        Comparator reference voltage.
+    beta : float or numpy.ndarray, optional
+        Inverse temperature of the comparator in 1/V, broadcast against V.
+        None or inf gives the deterministic comparator V > threshold.
+        A finite beta outputs 1 with probability sigmoid(beta * (V - threshold)).
+    rng : numpy.random.Generator, optional
+        Random generator for the stochastic comparator.
+
+    Returns
+    -------
+    numpy.ndarray
+        Digitized node states (0 or 1) with the shape of V broadcast against beta.
+    '''
+    if beta is None:
+        return (V > threshold).astype(int)
+    beta = np.asarray(beta, dtype=float)
+    if rng is None:
+        rng = np.random.default_rng()
+    dV = V - threshold
+    with np.errstate(invalid='ignore'):
+        p = expit(beta * dV)
+    p = np.where(np.isinf(beta), dV > 0, p)
+    return (rng.random(p.shape) < p).astype(int)
+
+
+class _RKMModel(object):
+    ''' Index arrays of an RKMNetwork needed to run the hardware protocol on its circuit. '''
+
+    def __init__(self, network, analogRails=(1.0, 3.0)):
+        self.network = network
+        self.NV = network.NV
+        self.NH = network.NH
+        self.analogRails = list(analogRails)
+        self.aZero = np.mean(analogRails)
+        self.circuit = network.circuit
+        self.Q = [self.circuit.constraint_matrix(network._clamp_nodes(FB)[0])
+                  for FB in (0, 1)]
+
+        # comparators read the + node of every unit
+        self.Vplus = network.topology.plus_nodes('V')
+        self.Hplus = network.topology.plus_nodes('H')
+
+        # unit state vector s = [A0, V0 .. V(NV-1), H0 .. H(NH-1)], A0 is always 1
+        units = {'A0': 0}
+        units.update({'V{}'.format(i): 1 + i for i in range(self.NV)})
+        units.update({'H{}'.format(i): 1 + self.NV + i for i in range(self.NH)})
+        self.Aidx = np.array([units[n] for n in network.edge.Anode])
+        self.Bidx = np.array([units[n] for n in network.edge.Bnode])
+        self.isWeight = network.edge.isWeight.to_numpy().astype(bool)
+        self.isVbias = ~self.isWeight & network.edge.Bnode.str.startswith('V').to_numpy()
+
+    def solve(self, FB, states, conductances):
+        ''' + node voltages of the free units with the other layer clamped to states. '''
+        _, F = self.network.clamp_patterns(FB=FB, patterns=states, analogRails=self.analogRails)
+        V = self.circuit.solve_batch(self.Q[FB], F, conductances)
+        return V[:, self.Hplus] if FB == 0 else V[:, self.Vplus]
+
+    def unit_states(self, V, H):
+        return np.hstack([np.ones((len(V), 1), dtype=int), V, H])
+
+    def reconstruct(self, Vtest, conductances, beta, rng):
+        ''' clamp V -> digitize H -> clamp H -> digitize V, as in the firmware reconstruct(). '''
+        H = digitize(self.solve(0, Vtest, conductances), self.aZero, beta, rng)
+        return digitize(self.solve(1, H, conductances), self.aZero, beta, rng)
+
+
+def sample_reconstructions(network, k, Vtest, betas, n_trials=1, analogRails=(1.0, 3.0), seed=None):
+    ''' Reconstructions of a test set by stochastic comparators at many inverse temperatures.
+
+    Runs the firmware reconstruct() (clamp V to the test pattern, digitize H,
+    clamp H, digitize V) for a fixed k state, for every (beta, trial, pattern)
+    at once: the circuit is factorized once per k state and every clamp is a
+    matrix product with its transfer matrix.
+
+    Parameters
+    ----------
+    network : RKMNetwork
+        Network whose circuit is solved.
+    k : array_like
+        Wiper values (n_edges,) shared by all trials, or (n_trials, n_edges).
+    Vtest : array_like
+        Binary test patterns (numtest, NV) shared by all trials, or
+        (n_trials, numtest, NV).
+    betas : array_like
+        Inverse temperatures of the comparators (1/V); None or inf gives the
+        deterministic comparator.
+    n_trials : int, optional
+        Number of independent samples, when neither k nor Vtest has a trial axis.
+    analogRails : tuple of float, optional
+        Low and high clamp voltages.
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    numpy.ndarray
+        int8 array (n_betas, n_trials, numtest, NV): for every beta and trial
+        the Vrecon of train_measure (Vrecon_det for a deterministic beta).
+        metrics_utils.mse(Vtest, Vrecon) gives the error of every (beta, trial).
+    '''
+    rng = np.random.default_rng(seed)
+    model = _RKMModel(network, analogRails)
+    k = np.atleast_2d(k)
+    Vtest = np.asarray(Vtest, dtype=int)
+    if k.shape[0] > 1:
+        n_trials = k.shape[0]
+    elif Vtest.ndim == 3:
+        n_trials = Vtest.shape[0]
+    betas = np.array([np.inf if b is None else b for b in np.atleast_1d(betas)], dtype=float)
+    betas = betas[:, None, None, None]
+
+    # transfer matrices of the clamped free units, (n_states, n_clamped, n_free)
+    G = network.get_conductances(k)
+    T = [model.circuit.transfer_batch(model.Q[FB], G)[:, plus].transpose(0, 2, 1)
+         for FB, plus in ((0, model.Hplus), (1, model.Vplus))]
+
+    def clamp(FB, states):
+        _, F = network.clamp_patterns(FB=FB, patterns=states.reshape(-1, states.shape[-1]),
+                                      analogRails=model.analogRails)
+        return F.reshape(states.shape[:-1] + F.shape[-1:]) @ T[FB]
+
+    aH = np.broadcast_to(clamp(0, Vtest if Vtest.ndim == 3 else Vtest[None]),
+                         (n_trials, Vtest.shape[-2], model.NH))
+    H = digitize(aH, model.aZero, betas, rng)
+    return digitize(clamp(1, H), model.aZero, betas, rng).astype(np.int8)
+
+
+def _adc_counts(V, nmestimes):
+    # analog_measurement() sums nmestimes 12 bit reads of the node voltage
+    return np.round(np.asarray(V) / READ_CONVERT).astype(int) * nmestimes
+
+
+def _initialize_uni(model, n_trials, kwvar, kbvar, krange, rng):
+    # edge firmware initialize_uni(): weights uniform in [-kwvar, kwvar), V biases kbvar, H biases 0
+    k = np.zeros((n_trials, len(model.isWeight)), dtype=int)
+    nW = model.isWeight.sum()
+    k[:, model.isWeight] = rng.integers(-kwvar, kwvar, size=(n_trials, nW)) if kwvar > 0 else 0
+    k[:, model.isVbias] = kbvar
+    return np.clip(k, *krange)
+
+
+def simulate_training(network,
+                      data,
+                      epochs,
+                      alpha=1,
+                      kwvar=10,
+                      kbvar=2,
+                      n_trials=1,
+                      numtest=20,
+                      beta=None,
+                      det_inference=False,
+                      measure_every=1,
+                      l2reg=1,
+                      maxl2reg=10000,
+                      krange=(-127, 127),
+                      analogRails=(1.0, 3.0),
+                      nmestimes=5,
+                      k_init=None,
+                      seed=None):
+    ''' Simulate the hardware training loop for an ensemble of trials.
+
+    Each trial follows the firmware train() routine: a random test set drawn
+    from the data and a random initial V state for the R phase, then for every
+    epoch and every data point (in random order) a D phase (clamp V to the data),
+    an R phase (clamp V, then H, then V again) and alpha updates of every
+    wiper with dk = DA*DB - RA*RB plus the stochastic L2 term. As on the board
+    (usePrev), the R phase of the first step clamps V to the initial state and
+    every later one to the V state of the previous R phase. Wipers are
+    integers clipped to krange. All trials are solved together.
+
+    Parameters
+    ----------
+    network : RKMNetwork
+        Network whose topology and circuit are simulated.
+    data : array_like
+        Binary training data. data has size numtrain x NV.
+    epochs : int
+        Number of training epochs.
+    alpha : int, optional
+        Number of update pulses per training step.
+    kwvar : int, optional
+        Weights are initialized uniformly in [-kwvar, kwvar).
+    kbvar : int, optional
+        Initial value of the biases of the visible units.
+    n_trials : int, optional
+        Number of independent trials simulated together.
+    numtest : int, optional
+        Number of test reconstructions per epoch.
+    beta : float, optional
+        Inverse temperature of the comparators (1/V). None for ideal comparators.
+    det_inference : bool, optional
+        Also report reconstructions with deterministic comparators
+        (Vtest_det, Vrecon_det), as with the 'detinf' firmware setting.
+    measure_every : int, optional
+        Report every measure_every epochs.
+    l2reg, maxl2reg : int, optional
+        L2 regularization: a wiper moves one step towards 0 with
+        probability |k| * l2reg / maxl2reg per update.
+    krange : tuple of int, optional
+        Range of the wiper values. The ideal digipot model has zero resistance
+        at |k| = 128, so the default stops one step short of it.
+    analogRails : tuple of float, optional
+        Low and high clamp voltages.
+    nmestimes : int, optional
+        Number of ADC reads summed in the analog measurements.
+    k_init : array_like, optional
+        Initial wiper values (n_edges, or n_trials x n_edges) instead of the
+        uniform initialization.
+    seed : int, optional
+        Seed of the random generator. The same seed gives the same ensemble.
+
+    Returns
+    -------
+    list of list of dict
+        For every trial, the list of records ReadWrite.train_measure returns:
+        an initial record with the reconstructions before training and the
+        initial wipers (epoch -1), then one record per measured epoch with
+        ki, DA, DB, RA, RB, analog measurements and reconstructions.
+    '''
+    rng = np.random.default_rng(seed)
+    model = _RKMModel(network, analogRails)
+    data = np.atleast_2d(np.asarray(data, dtype=int))
+    numtrain = len(data)
+    T = n_trials
+
+    testidx = rng.integers(numtrain, size=(T, numtest))
+    Vtest = data[testidx]
+    Vinit = rng.integers(2, size=(T, model.NV))
+    if k_init is None:
+        k = _initialize_uni(model, T, kwvar, kbvar, krange, rng)
+    else:
+        k = np.clip(np.broadcast_to(np.asarray(k_init, dtype=int), (T, len(model.isWeight))), *krange)
+
+    def test_reconstruction(record):
+        G = np.repeat(network.get_conductances(k), numtest, axis=0)
+        flat = Vtest.reshape(T * numtest, model.NV)
+        if det_inference:
+            Vrecon = model.reconstruct(flat, G, None, rng).reshape(T, numtest, model.NV)
+            for t in range(T):
+                record[t]['Vtest_det'] = Vtest[t].tolist()
+                record[t]['Vrecon_det'] = Vrecon[t].tolist()
+        Vrecon = model.reconstruct(flat, G, beta, rng).reshape(T, numtest, model.NV)
+        for t in range(T):
+            record[t]['Vtest'] = Vtest[t].tolist()
+            record[t]['Vrecon'] = Vrecon[t].tolist()
+
+    first = [{'ki': k[t].tolist(), 'epoch': -1, 'trainingstep': -1} for t in range(T)]
+    test_reconstruction(first)
+    records = [[first[t]] for t in range(T)]
+
+    trainingstep = 0
+    mstep = 0
+    Vprev = Vinit
+    for epoch in range(epochs):
+        mstep += 1
+        aRecord = int(mstep == measure_every)
+        order = rng.permuted(np.tile(np.arange(numtrain), (T, 1)), axis=1)
+        for pi in range(numtrain):
+            G = network.get_conductances(k)
+
+            # D state: clamp V to the data, digitize H
+            Vd = data[order[:, pi]]
+            Hd = digitize(model.solve(0, Vd, G), model.aZero, beta, rng)
+
+            # R state: forward from the stored V (Vinit in the first step), backward, forward again
+            H1 = digitize(model.solve(0, Vprev, G), model.aZero, beta, rng)
+            aV = model.solve(1, H1, G)
+            V1 = digitize(aV, model.aZero, beta, rng)
+            Vprev = V1
+            aH = model.solve(0, V1, G)
+            H2 = digitize(aH, model.aZero, beta, rng)
+
+            sD = model.unit_states(Vd, Hd)
+            sR = model.unit_states(V1, H2)
+            DA, DB = sD[:, model.Aidx], sD[:, model.Bidx]
+            RA, RB = sR[:, model.Aidx], sR[:, model.Bidx]
+
+            for al in range(alpha):
+                l2 = np.where(np.abs(k) * l2reg > rng.integers(maxl2reg, size=k.shape),
+                              np.where(k >= 0, -1, 1), 0)
+                k = np.clip(k + DA * DB - RA * RB + l2, *krange)
+            trainingstep += 1
+
+        if mstep == measure_every:
+            mstep = 0
+            record = [{
+                'aRecord': aRecord,
+                'usePrev': 1,
+                'nmestimes': nmestimes,
+                'analogZero': int(_adc_counts(model.aZero, nmestimes)),
+                'analogV': _adc_counts(aV[t], nmestimes).tolist(),
+                'analogH': _adc_counts(aH[t], nmestimes).tolist(),
+                'epoch': epoch,
+                'trainingstep': trainingstep - 1,
+                'ki': k[t].tolist(),
+                'DA': DA[t].tolist(),
+                'DB': DB[t].tolist(),
+                'RA': RA[t].tolist(),
+                'RB': RB[t].tolist(),
+            } for t in range(T)]
+            test_reconstruction(record)
+            for t in range(T):
+                records[t].append(record[t])
+    return records
+
+
+_worker_network = None
+
+
+def _init_worker(network):
+    # runs once per worker process: the network and its precomputed indices arrive here only
+    global _worker_network
+    _worker_network = network
+
+
+def _run_task(index, seed, params, data, epochs, kwargs):
+    options = dict(kwargs)
+    options.update(params)
+    return index, simulate_training(_worker_network, data, epochs, seed=seed, **options)
+
+
+def _expand_grid(grid):
+    if grid is None:
+        return [{}]
+    if isinstance(grid, dict):
+        names = list(grid)
+        return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    return [dict(params) for params in grid]
+
+
+def iter_ensemble(network, data, epochs, grid=None, seeds=(0,), max_workers=None, **kwargs):
+    ''' Run simulate_training over a (seed, hyperparameter) grid in a process pool.
+
+    The network, with its circuit and clamp indices already built, is sent to
+    every worker once when the pool starts; the tasks only carry the seed and
+    hyperparameters. Every task is seeded by its own seed, so results do not
+    depend on the number of workers or on the order in which tasks finish.
+    When the caller stops iterating, tasks that have not started are cancelled.
+
+    Parameters
+    ----------
+    network : RKMNetwork
+        Network to simulate.
+    data : array_like
+        Binary training data. data has size numtrain x NV.
+    epochs : int
+        Number of training epochs.
+    grid : dict or list of dict, optional
+        Hyperparameters passed to simulate_training. A dict of lists is
+        expanded to every combination, e.g. {'alpha': [1, 2], 'kwvar': [10, 20]}.
+    seeds : iterable of int, optional
+        Seeds run for every grid point.
+    max_workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    **kwargs
+        Further arguments of simulate_training shared by all tasks (e.g. n_trials).
+
+    Yields
+    ------
+    tuple
+        (seed, params, records) for every task, as soon as it finishes.
+    '''
+    tasks = [(seed, params) for params in _expand_grid(grid) for seed in seeds]
+    for index, records in _iter_tasks(network, data, epochs, tasks, max_workers, kwargs):
+        seed, params = tasks[index]
+        yield seed, params, records
+
+
+def _iter_tasks(network, data, epochs, tasks, max_workers, kwargs):
+    # (task index, records) as the tasks finish; tasks not started yet are
+    # cancelled when the caller stops early
+    network.circuit
+    for FB in (0, 1):
+        network.clamp_patterns(FB=FB)
+    pool = ProcessPoolExecutor(max_workers=max_workers,
+                               initializer=_init_worker,
+                               initargs=(network,))
+    try:
+        futures = [pool.submit(_run_task, index, seed, params, data, epochs, kwargs)
+                   for index, (seed, params) in enumerate(tasks)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def run_ensemble(network, data, epochs, grid=None, seeds=(0,), max_workers=None, **kwargs):
+    ''' Run iter_ensemble to completion.
+
+    Returns
+    -------
+    list of tuple
+        (seed, params, records) for every task, ordered by grid point, then seed.
+    '''
+    tasks = [(seed, params) for params in _expand_grid(grid) for seed in seeds]
+    results = [None] * len(tasks)
+    for index, records in _iter_tasks(network, data, epochs, tasks, max_workers, kwargs):
+        results[index] = records
+    return [(seed, params, records) for (seed, params), records in zip(tasks, results)]
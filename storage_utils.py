@@ -0,0 +1,380 @@
+''' Columnar storage of training trajectories.
+
+A trajectory (one training trial, one row per recorded epoch) is stored as a
+directory with one .npy file per column and a meta.json listing the columns:
+
+    train00/
+        meta.json
+        epoch.npy         (n_rows,)            int16
+        W00.npy           (n_rows,)            int8
+        ...
+        Vtest.npy         (n_rows, numtest, NV) int8
+        Vrecon.npy        (n_rows, numtest, NV) int8
+
+Integer columns are stored in the smallest integer type that holds them and
+float columns keep their dtype; Vtest/Vrecon (and their _det variants) are
+dense 3-D arrays, int8 for binary states and float32 otherwise. Columns of
+per-row lists, such as ki or DA in the records of ReadWrite.train_measure,
+are 2-D arrays. Single .npy
+files can be memory-mapped, so a column is read without touching the others.
+'''
+import ast
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from metrics_utils import mse
+
+FORMAT_VERSION = 1
+ARRAY_COLUMNS = ('Vtest', 'Vrecon', 'Vtest_det', 'Vrecon_det')
+
+
+def _parse_cell(cell):
+    if isinstance(cell, str):
+        return ast.literal_eval(cell)
+    return cell
+
+
+def _stack(values, name):
+    ''' (n_rows, numtest, NV) array of the per-row reconstruction arrays of a column. '''
+    try:
+        arr = np.array([_parse_cell(v) for v in values])
+    except ValueError:
+        raise ValueError('{} arrays do not all have the same shape'.format(name))
+    if arr.ndim != 3:
+        raise ValueError('{} should hold one (numtest, NV) array per row'.format(name))
+    if np.all(np.isin(arr, (0, 1))):
+        return arr.astype(np.int8)
+    return arr.astype(np.float32)
+
+
+def _object_column(values, name):
+    ''' Numeric array of a column of numeric strings (msgvar values) or of equal-length lists (ki, DA, ...). '''
+    try:
+        return pd.to_numeric(values).to_numpy()
+    except (ValueError, TypeError):
+        pass
+    try:
+        arr = np.array([_parse_cell(v) for v in values])
+    except (ValueError, SyntaxError):
+        arr = None
+    if arr is None or arr.ndim != 2 or arr.dtype.kind not in 'biuf':
+        raise ValueError('column {} is not numeric'.format(name))
+    return arr
+
+
+def save_trajectory(path, df):
+    ''' Write one training trajectory in the columnar format.
+
+    Parameters
+    ----------
+    path : str
+        Directory to write; created if needed, existing columns are overwritten.
+    df : pandas.DataFrame
+        One row per recorded epoch, as built from ReadWrite.train_measure or
+        read from a trainXX.csv file. Vtest/Vrecon cells may be nested lists,
+        arrays or their string representation. Columns of numeric strings are
+        converted to numbers, and columns of equal-length lists (e.g. ki or DA
+        of the records) are stored as 2-D arrays.
+    '''
+    os.makedirs(path, exist_ok=True)
+    columns = [c for c in df.columns if not str(c).startswith('Unnamed')]
+    for name in columns:
+        if name in ARRAY_COLUMNS:
+            arr = _stack(df[name], name)
+        else:
+            arr = df[name].to_numpy()
+            if arr.dtype == object:
+                arr = _object_column(df[name], name)
+            if arr.dtype.kind == 'i' and len(arr):
+                # k values and node states fit in far fewer bits than int64
+                arr = arr.astype(np.result_type(np.min_scalar_type(arr.min()),
+                                                np.min_scalar_type(arr.max()), np.int8))
+        np.save(os.path.join(path, name + '.npy'), arr)
+    meta = {'format': FORMAT_VERSION, 'rows': len(df), 'columns': columns}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def read_meta(path):
+    ''' Contents of the meta.json of a stored trajectory. '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError('unsupported trajectory format {!r} in {}'.format(meta.get('format'), path))
+    return meta
+
+
+def load_arrays(path, columns=None, mmap_mode=None):
+    ''' Columns of a stored trajectory as a dict of numpy arrays.
+
+    Parameters
+    ----------
+    path : str
+        Trajectory directory written by save_trajectory.
+    columns : list of str, optional
+        Columns to load. Default: all.
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional
+        Memory-map the column files instead of reading them (see numpy.load).
+
+    Returns
+    -------
+    dict
+        Column name to array, in stored column order.
+    '''
+    meta = read_meta(path)
+    if columns is None:
+        columns = meta['columns']
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in columns}
+
+
+def load_trajectory(path, columns=None):
+    ''' Stored trajectory as a DataFrame laid out like the training CSV files.
+
+    Vtest/Vrecon cells hold (numtest, NV) arrays (views of one 3-D array), as
+    do the cells of other 2-D columns, and integer columns are widened back
+    to int64, so k differences do not wrap.
+    '''
+    data = {}
+    for name, arr in load_arrays(path, columns).items():
+        if arr.dtype.kind == 'i' and name not in ARRAY_COLUMNS:
+            arr = arr.astype(np.int64)
+        data[name] = list(arr) if arr.ndim > 1 else arr
+    return pd.DataFrame(data)
+
+
+def convert_csv(csvpath, path=None):
+    ''' Convert a trainXX.csv file to the columnar format; returns the trajectory directory.
+
+    path defaults to the csv path without its extension.
+    '''
+    if path is None:
+        path = os.path.splitext(csvpath)[0]
+    save_trajectory(path, pd.read_csv(csvpath))
+    return path
+
+
+def convert_directory(directory, pattern='train*.csv'):
+    ''' Convert every csv matching pattern in directory; returns the trajectory directories. '''
+    return [convert_csv(csvpath)
+            for csvpath in sorted(glob.glob(os.path.join(directory, pattern)))]
+
+
+class _EdgeView(object):
+    ''' k values of an ensemble indexed as [trial, row, edge]; only the selected trials are read. '''
+
+    def __init__(self, ensemble):
+        self._ensemble = ensemble
+
+    @property
+    def shape(self):
+        return len(self._ensemble), self._ensemble.n_rows, len(self._ensemble.edges)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        trials, rows, edges = key
+        edges = np.arange(len(self._ensemble.edges))[edges]
+        names = [self._ensemble.edges[j] for j in np.atleast_1d(edges)]
+        selected = np.arange(len(self._ensemble))[trials]
+        out = np.array([np.stack([self._ensemble._column(t, name)[:self._ensemble.n_rows][rows]
+                                  for name in names], axis=-1)
+                        for t in np.atleast_1d(selected)])
+        # drop the axes indexed by integers
+        if np.ndim(edges) == 0:
+            out = out[..., 0]
+        if np.ndim(selected) == 0:
+            out = out[0]
+        return out
+
+
+class TrainingEnsemble(object):
+    ''' Memory-mapped training trials stored with save_trajectory.
+
+    Trials are the trajectory directories matching pattern in directory, in
+    sorted order. Column files are memory-mapped the first time they are used,
+    so only the pages actually indexed are read. Rows beyond the shortest
+    trial (e.g. an interrupted run) are ignored by the ensemble-wide accessors.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the trajectory directories (e.g. converted trainXX.csv files).
+    pattern : str, optional
+        Glob pattern of the trajectory directories.
+
+    Attributes
+    ----------
+    paths : list of str
+        Trajectory directory of every trial.
+    columns : list of str
+        Columns of the first trial.
+    edges : list of str
+        Edge (k value) columns, the last axis of k.
+    n_rows : int
+        Rows (recorded epochs, including the initial state) of the shortest trial.
+    k : _EdgeView
+        k values sliced as ``ensemble.k[trial, row, edge]``.
+    '''
+
+    def __init__(self, directory, pattern='train*'):
+        self.paths = [p for p in sorted(glob.glob(os.path.join(directory, pattern)))
+                      if os.path.isfile(os.path.join(p, 'meta.json'))]
+        if not self.paths:
+            raise ValueError('no stored trajectories matching {} in {}'.format(pattern, directory))
+        metas = [read_meta(p) for p in self.paths]
+        self.columns = metas[0]['columns']
+        self.edges = [c for c in self.columns if c.startswith(('BV', 'BH', 'W'))]
+        self.n_rows = min(meta['rows'] for meta in metas)
+        self.k = _EdgeView(self)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def trial(self, i):
+        ''' Memory-mapped columns of trial i, as a dict of arrays. '''
+        return {name: self._column(i, name) for name in read_meta(self.paths[i])['columns']}
+
+    def _column(self, i, name):
+        # memory-maps single column files on first use
+        if (i, name) not in self._columns:
+            self._columns[i, name] = np.load(os.path.join(self.paths[i], name + '.npy'), mmap_mode='r')
+        return self._columns[i, name]
+
+    def __getitem__(self, i):
+        return self.trial(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.trial(i)
+
+    def column(self, name, trials=None):
+        ''' (n_trials, n_rows, ...) array of one column over the selected trials. '''
+        trials = range(len(self)) if trials is None else trials
+        return np.array([self._column(t, name)[:self.n_rows] for t in trials])
+
+    def mse(self, trial):
+        ''' Reconstruction error of every row of one trial, from the stored MSE or from Vtest/Vrecon. '''
+        if 'MSE' in self.columns:
+            return np.asarray(self._column(trial, 'MSE')[:self.n_rows], dtype=np.float64)
+        return mse(self._column(trial, 'Vtest')[:self.n_rows],
+                   self._column(trial, 'Vrecon')[:self.n_rows])
+
+    def stats(self, name='MSE'):
+        ''' Mean and standard deviation across trials of a column, per row.
+
+        Trials are read one at a time (Welford's update), so memory does not
+        grow with the number of trials. name='MSE' falls back to computing
+        the error from Vtest/Vrecon when no MSE column is stored.
+
+        Returns
+        -------
+        mean, std : numpy.ndarray
+            Arrays of shape (n_rows, ...) (population std, as numpy.std).
+        '''
+        mean = m2 = 0.
+        for t in range(len(self)):
+            n = t + 1
+            if name == 'MSE':
+                x = self.mse(t)
+            else:
+                x = np.asarray(self._column(t, name)[:self.n_rows], dtype=np.float64)
+            delta = x - mean
+            mean = mean + delta / n
+            m2 = m2 + delta * (x - mean)
+        return mean, np.sqrt(m2 / len(self))
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+class EpochLog(object):
+    ''' Append-only JSON-lines log of training records, one line per finalized epoch.
+
+    An EpochLog is a callable record sink (e.g. the callback of
+    ReadWrite.train_measure): every record is written and flushed as soon as
+    it arrives, so a crash loses at most the epoch in progress and memory
+    does not grow with the run. Opening an existing log drops a partial last
+    line left by a crash and appends after the complete records.
+
+    Parameters
+    ----------
+    path : str
+        Log file, created if needed.
+    fsync : bool, optional
+        Also fsync after every record, so records survive a power loss.
+
+    Attributes
+    ----------
+    n_records : int
+        Records in the log, including those written before it was opened.
+    '''
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.n_records = self._repair()
+        self._file = open(path, 'a')
+
+    def _repair(self):
+        if not os.path.exists(self.path):
+            return 0
+        n_records = end = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                n_records += 1
+                end += len(line)
+        if end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        return n_records
+
+    def __call__(self, record):
+        self._file.write(json.dumps(record, default=_json_default) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.n_records += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_epoch_log(path):
+    ''' Records of an EpochLog file, one dict per epoch.
+
+    A partial last line (the run crashed while writing it) is skipped; a
+    corrupt line elsewhere raises ValueError.
+    '''
+    with open(path) as f:
+        for n, line in enumerate(f):
+            if not line.endswith('\n'):
+                return
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise ValueError('corrupt record on line {} of {}'.format(n + 1, path))
+
+
+def read_epoch_log(path):
+    ''' All complete records of an EpochLog file, as a list of dicts (see iter_epoch_log). '''
+    return list(iter_epoch_log(path))
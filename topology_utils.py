@@ -0,0 +1,200 @@
+''' Index-array description of the RKM network topology.
+
+RKMTopology describes the logical network (bias and weight edges between the
+L/R rails and the visible/hidden units) and the full circuit (a + and a - node
+per unit, three resistor legs per weight) with integer arrays, in the node and
+edge order of the networkx graphs RKMNetwork has always used. Names are only
+derived for display and for the edge/node key DataFrames; networkx graphs are
+built on request.
+'''
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+
+class RKMTopology(object):
+    ''' Nodes and edges of an NV x NH RKM network as index arrays.
+
+    Logical node i is L (0), R (1), visible unit V(i-2) (2 <= i < 2+NV) or
+    hidden unit H(i-2-NV); its + and - nodes in the full graph are 2i and 2i+1.
+
+    Parameters
+    ----------
+    NV, NH : int
+        Numbers of visible and hidden units.
+    ysep, lrxsep, midxsep, pmsep : float, optional
+        Layout spacings, as in RKMNetwork.generate.
+
+    Attributes
+    ----------
+    edge_kind : numpy.ndarray
+        VBIAS, HBIAS or WEIGHT for every logical edge.
+    edge_v, edge_h : numpy.ndarray
+        Visible/hidden unit of every logical edge (-1 where it has none).
+    edge_a, edge_b : numpy.ndarray
+        Logical end nodes of every logical edge (COO edge list).
+    full_a, full_b : numpy.ndarray
+        Full-graph end nodes of every full edge.
+    full_edge : numpy.ndarray
+        Logical edge of every full edge.
+    full_pm : numpy.ndarray
+        Polarity of every full edge: True for the leg conducting when k > 0.
+    '''
+
+    VBIAS, HBIAS, WEIGHT = 0, 1, 2
+
+    def __init__(self, NV, NH, ysep=2., lrxsep=2., midxsep=4., pmsep=0.4):
+        self.NV = NV
+        self.NH = NH
+        self._layout = (ysep, lrxsep, midxsep, pmsep)
+        v = np.arange(NV)
+        h = np.arange(NH)
+        Vnode = 2 + v
+        Hnode = 2 + NV + h
+
+        # logical edges: L-V biases, R-H biases, then weights with V major
+        wv = np.repeat(v, NH)
+        wh = np.tile(h, NV)
+        self.edge_kind = np.concatenate([np.full(NV, self.VBIAS), np.full(NH, self.HBIAS),
+                                         np.full(NV * NH, self.WEIGHT)])
+        self.edge_v = np.concatenate([v, np.full(NH, -1), wv])
+        self.edge_h = np.concatenate([np.full(NV, -1), h, wh])
+        self.edge_a = np.concatenate([np.zeros(NV, int), np.ones(NH, int), 2 + wv])
+        self.edge_b = np.concatenate([Vnode, Hnode, 2 + NV + wh])
+
+        # full edges: L+/L- to every V+, R+/R- to every H+, then per visible unit
+        # V+H0+, V+H0-, V+H1+, ... followed by V-H0+, V-H1+, ...
+        nb = NV + NH
+        wedge = (nb + np.arange(NV * NH)).reshape(NV, NH)
+        Vp = np.broadcast_to(2 * Vnode[:, None], (NV, NH))
+        Hp = np.broadcast_to(2 * Hnode[None, :], (NV, NH))
+        plus = [np.stack([Vp, Vp], axis=-1).reshape(NV, 2 * NH),
+                np.stack([Hp, Hp + 1], axis=-1).reshape(NV, 2 * NH),
+                np.repeat(wedge, 2, axis=1),
+                np.tile([True, False], (NV, NH))]
+        minus = [Vp + 1, Hp, wedge, np.zeros((NV, NH), bool)]
+        weights = [np.concatenate([p, m], axis=1).ravel() for p, m in zip(plus, minus)]
+        self.full_a = np.concatenate([np.zeros(NV, int), np.ones(NV, int),
+                                      np.full(NH, 2), np.full(NH, 3), weights[0]])
+        self.full_b = np.concatenate([2 * Vnode, 2 * Vnode, 2 * Hnode, 2 * Hnode, weights[1]])
+        self.full_edge = np.concatenate([v, v, NV + h, NV + h, weights[2]])
+        self.full_pm = np.concatenate([np.ones(NV, bool), np.zeros(NV, bool),
+                                       np.ones(NH, bool), np.zeros(NH, bool), weights[3]])
+
+    @property
+    def n_nodes(self):
+        return 2 + self.NV + self.NH
+
+    @property
+    def n_edges(self):
+        return len(self.edge_kind)
+
+    def plus_nodes(self, layer):
+        ''' Full-graph indices of the + nodes of the 'V' or 'H' units, in unit order. '''
+        first = {'V': 2, 'H': 2 + self.NV}[layer]
+        count = {'V': self.NV, 'H': self.NH}[layer]
+        return 2 * (first + np.arange(count))
+
+    # ------------------------------------------------------------------ names
+
+    @property
+    def node_names(self):
+        ''' Names of the logical nodes: L, R, V0, ..., H0, ... '''
+        return (['L', 'R'] + ['V{}'.format(i) for i in range(self.NV)]
+                + ['H{}'.format(j) for j in range(self.NH)])
+
+    @property
+    def full_node_names(self):
+        return [name + pm for name in self.node_names for pm in '+-']
+
+    @property
+    def edge_names(self):
+        ''' Display names of the logical edges.
+
+        Weights are named W<v><h> (W01) while every unit index is a single
+        digit, as on the hardware, and W<v>_<h> (W10_3) otherwise, where the
+        concatenated form would be ambiguous.
+        '''
+        sep = '' if max(self.NV, self.NH) <= 10 else '_'
+        return (['BV{}'.format(i) for i in range(self.NV)]
+                + ['BH{}'.format(j) for j in range(self.NH)]
+                + ['W{}{}{}'.format(i, sep, j) for i in range(self.NV) for j in range(self.NH)])
+
+    def edge_frame(self):
+        ''' Edge keys as built by RKMNetwork.set_keys: name, isWeight, Anode, Bnode. '''
+        names = np.array(self.node_names, dtype=object)
+        isweight = (self.edge_kind == self.WEIGHT).astype(int)
+        anode = np.where(isweight, names[self.edge_a], 'A0')
+        return pd.DataFrame({'name': self.edge_names, 'isWeight': isweight,
+                             'Anode': anode, 'Bnode': names[self.edge_b]})
+
+    def node_frame(self):
+        ''' Node keys as built by RKMNetwork.set_keys (A0 and the unit names, sorted). '''
+        return pd.DataFrame({'name': np.unique(['A0'] + self.node_names[2:])})
+
+    @classmethod
+    def from_frame(cls, edge_frame, **layout):
+        ''' Topology of an edge key DataFrame (see edge_frame).
+
+        Raises
+        ------
+        ValueError
+            If the frame does not describe a complete NV x NH RKM in edge order.
+        '''
+        units = pd.concat([edge_frame.Anode, edge_frame.Bnode])
+        units = units[units != 'A0']
+        NV = units.str.startswith('V').pipe(lambda m: units[m]).str[1:].astype(int).max() + 1
+        NH = units.str.startswith('H').pipe(lambda m: units[m]).str[1:].astype(int).max() + 1
+        topology = cls(int(NV), int(NH), **layout)
+        expected = topology.edge_frame()
+        for key in ('isWeight', 'Anode', 'Bnode'):
+            if not np.array_equal(np.asarray(edge_frame[key]), expected[key].to_numpy()):
+                raise ValueError('edge frame is not an {}x{} RKM in edge order ({} differs)'.format(NV, NH, key))
+        return topology
+
+    # ----------------------------------------------------------------- layout
+
+    def _unit_y(self, count):
+        return -(np.arange(count) + 0.5 - count / 2.) * self._layout[0]
+
+    def positions(self):
+        ''' (n_nodes, 2) layout of the logical nodes. '''
+        ysep, lrxsep, midxsep, pmsep = self._layout
+        pos = np.zeros((self.n_nodes, 2))
+        pos[1, 0] = lrxsep * 2 + midxsep
+        pos[2:2 + self.NV] = np.stack([np.full(self.NV, lrxsep), self._unit_y(self.NV)], axis=1)
+        pos[2 + self.NV:] = np.stack([np.full(self.NH, lrxsep + midxsep), self._unit_y(self.NH)], axis=1)
+        return pos
+
+    def full_positions(self):
+        ''' (2 n_nodes, 2) layout of the full graph: + above and - below every logical node. '''
+        pmsep = self._layout[3]
+        offset = np.full(self.n_nodes, pmsep)
+        offset[:2] = 2 * pmsep
+        pos = np.repeat(self.positions(), 2, axis=0)
+        pos[0::2, 1] += offset
+        pos[1::2, 1] -= offset
+        return pos
+
+    # --------------------------------------------------------------- networkx
+
+    def graph(self, k=None):
+        ''' networkx graph of the logical network, edges with name and k attributes. '''
+        names = self.node_names
+        k = np.zeros(self.n_edges, int) if k is None else np.asarray(k)
+        G = nx.Graph()
+        G.add_nodes_from(names)
+        G.add_edges_from((names[a], names[b], {'name': name, 'k': int(kk)})
+                         for a, b, name, kk in zip(self.edge_a, self.edge_b, self.edge_names, k))
+        return G
+
+    def fullgraph(self):
+        ''' networkx graph of the full circuit, nodes with pos/name/pm and edges with name/pm. '''
+        names = self.full_node_names
+        edge_names = self.edge_names
+        G = nx.Graph()
+        G.add_nodes_from((name, {'pos': list(p), 'name': name[:-1], 'pm': int(name[-1] == '+')})
+                         for name, p in zip(names, self.full_positions()))
+        G.add_edges_from((names[a], names[b], {'name': edge_names[e], 'pm': int(pm)})
+                         for a, b, e, pm in zip(self.full_a, self.full_b, self.full_edge, self.full_pm))
+        return G